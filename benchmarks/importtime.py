@@ -0,0 +1,73 @@
+"""
+Measures how long it takes to import jprops using ``python -X importtime``.
+
+Exits with an error if the import takes longer than the budget, to catch
+regressions in startup time::
+
+  python benchmarks/importtime.py --budget 5
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+root = os.path.dirname(here)
+
+
+def import_time():
+  # returns the cumulative import time of jprops in microseconds, and the other
+  # modules it imported
+  env = dict(os.environ)
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  env['PYTHONPATH'] = root
+  output = subprocess.check_output(
+    [sys.executable, '-X', 'importtime', '-c', 'import jprops'],
+    stderr=subprocess.STDOUT,
+    env=env,
+    cwd=root,
+  ).decode('utf-8')
+
+  imported = []
+  for line in output.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    _, cumulative_us, name = line.split('|')
+    # nested imports are indented past the space after the separator
+    name = name[1:]
+    if not name.startswith('  '):
+      # a top-level import, so anything nested before it isn't from jprops
+      if name.strip() == 'jprops':
+        return int(cumulative_us), imported
+      imported = []
+    else:
+      imported.append(name.strip())
+
+  raise RuntimeError('jprops was not imported:\n' + output)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--budget', type=float, default=5.0,
+                      help='maximum import time in milliseconds (default: 5)')
+  parser.add_argument('--repeat', type=int, default=10,
+                      help='number of times to import (default: 10)')
+  args = parser.parse_args()
+
+  # the first import writes the bytecode cache
+  import_time()
+  best, modules = min(import_time() for _ in range(args.repeat))
+  best_ms = best / 1000.0
+
+  print('import jprops: %.2f ms (budget %.2f ms)' % (best_ms, args.budget))
+  print('also imported: %s' % (', '.join(modules) or 'nothing'))
+  if best_ms > args.budget:
+    print('over budget!')
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
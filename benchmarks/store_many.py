@@ -0,0 +1,72 @@
+"""
+Measures how many rows per second ``store_properties`` and ``store_many`` write.
+
+Writes the same generated rows to an in-memory binary and text file with each
+API, and reports the best rows/sec of several runs::
+
+  python benchmarks/store_many.py --rows 1000000
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import jprops
+
+
+def make_rows(count):
+  keys = [u'export.row.%d.name' % idx for idx in range(count)]
+  values = [u'value %d: caf\u00e9 #%d' % (idx, idx % 97) for idx in range(count)]
+  return keys, values
+
+
+def store_properties(fh, keys, values):
+  jprops.store_properties(fh, zip(keys, values), timestamp=False)
+
+
+def store_many(fh, keys, values):
+  jprops.store_many(fh, keys, values)
+
+
+def store_many_trusted(fh, keys, values):
+  jprops.store_many(fh, keys, values, trusted=True)
+
+
+def rows_per_sec(write, file_type, keys, values, repeat):
+  best = None
+  for _ in range(repeat):
+    fh = file_type()
+    start = time.time()
+    write(fh, keys, values)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return len(keys) / best
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--rows', type=int, default=200000,
+                      help='number of rows to write (default: 200000)')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='number of times to write the rows (default: 3)')
+  args = parser.parse_args()
+
+  keys, values = make_rows(args.rows)
+  for file_type in (io.BytesIO, io.StringIO):
+    baseline = None
+    for write in (store_properties, store_many, store_many_trusted):
+      rate = rows_per_sec(write, file_type, keys, values, args.repeat)
+      baseline = baseline or rate
+      print('%-9s %-20s %12.0f rows/sec  %5.1fx' % (
+        file_type.__name__, write.__name__, rate, rate / baseline))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,8 +1,20 @@
+# Only modules which are already loaded when Python starts are imported here, so
+# that importing jprops stays fast. Other modules are imported where they're
+# used, and regexes are compiled the first time they're used.
+import codecs
 import io
-import re
-import string
+import itertools
 import sys
-import time
+
+try:
+  # collections.abc imports the whole collections package, but the module it
+  # wraps is already loaded at startup
+  from _collections_abc import Mapping
+except ImportError:
+  try:
+    from collections.abc import Mapping
+  except ImportError:
+    from collections import Mapping
 
 
 PY2 = sys.version_info[0] == 2
@@ -10,10 +22,12 @@ if not PY2:
   text_type = str
   string_types = (str,)
   unichr = chr
+  izip = zip
 else:
   text_type = unicode
   string_types = (str, unicode)
   unichr = unichr
+  izip = itertools.izip
 
 
 class _CommentSentinel(object):
@@ -31,7 +45,57 @@ class _CommentSentinel(object):
 COMMENT = _CommentSentinel()
 
 
-def load_properties(fh, mapping=dict):
+class _LazyPattern(object):
+  # stands in for a compiled regex until it's first used, then replaces itself
+  # in the module so that later uses go straight to the compiled regex
+  __slots__ = ('_name', '_pattern', '_compiled')
+
+  def __init__(self, name, pattern):
+    self._name = name
+    self._pattern = pattern
+    self._compiled = None
+
+  def __getattr__(self, attr):
+    if self._compiled is None:
+      self._compiled = self._compile(self._pattern)
+      globals()[self._name] = self._compiled
+    return getattr(self._compiled, attr)
+
+  @staticmethod
+  def _compile(pattern):
+    import re
+    return re.compile(pattern)
+
+
+def _record_type(name, fields):
+  # a lightweight namedtuple, since the collections module is slow to import
+  def __new__(cls, *args, **kwargs):
+    values = args + tuple(kwargs.pop(field) for field in fields[len(args):])
+    if len(values) != len(fields) or kwargs:
+      raise TypeError('%s() takes %d arguments' % (name, len(fields)))
+    return tuple.__new__(cls, values)
+
+  def __repr__(self):
+    return '%s(%s)' % (name, ', '.join(
+      '%s=%r' % item for item in zip(fields, self)))
+
+  def __getnewargs__(self):
+    return tuple(self)
+
+  namespace = {
+    '__slots__': (),
+    '__new__': __new__,
+    '__repr__': __repr__,
+    '__getnewargs__': __getnewargs__,
+    '__module__': __name__,
+    '_fields': fields,
+  }
+  for idx, field in enumerate(fields):
+    namespace[field] = property(lambda self, idx=idx: self[idx])
+  return type(name, (tuple,), namespace)
+
+
+def load_properties(fh, mapping=dict, encoding=None, locations=None):
   """
     Reads properties from a Java .properties file.
 
@@ -39,18 +103,39 @@ def load_properties(fh, mapping=dict):
 
     :param fh: a readable file-like object
     :param mapping: mapping type to load properties into
+    :param encoding: encoding of a binary file (default: latin-1), see
+      ``iter_properties``
+    :param locations: a ``jprops.PropertyLocations`` to record where each
+      property was read from
   """
-  return mapping(iter_properties(fh))
+  if locations is None:
+    return mapping(iter_properties(fh, encoding=encoding))
 
+  props = iter_properties(fh, encoding=encoding, locations=True)
+  return mapping(_record_locations(props, locations))
 
-def store_properties(fh, props, comment=None, timestamp=True):
+
+def store_properties(fh, props, comment=None, timestamp=True,
+                     sort_keys=False, sort_buffer_size=None):
   """
     Writes properties to the file in Java properties format.
 
+    Properties are written as they are read from ``props``, so an iterable of
+    pairs (such as a generator) is never loaded into memory all at once.
+
+    If ``sort_keys`` is `True` the properties are written ordered by key, which
+    combined with ``timestamp=False`` gives byte-identical output for the same
+    properties. Sorting an iterable of pairs normally holds all of the pairs in
+    memory, but if ``sort_buffer_size`` is given, at most that many pairs are
+    held at once and sorted runs are spilled to temporary files and merged.
+
     :param fh: a writable file-like object
     :param props: a mapping (dict) or iterable of key/value pairs
     :param comment: comment to write to the beginning of the file
     :param timestamp: boolean indicating whether to write a timestamp comment
+    :param sort_keys: should write the properties sorted by key (default: False)
+    :param sort_buffer_size: maximum number of pairs to sort in memory when
+      ``props`` is an iterable of pairs (default: unlimited)
   """
   w = _property_writer(fh)
 
@@ -58,12 +143,16 @@ def store_properties(fh, props, comment=None, timestamp=True):
     w.write_comment(comment)
 
   if timestamp:
+    import time
     w.write_comment(time.strftime('%a %b %d %H:%M:%S %Z %Y'))
 
   if hasattr(props, 'keys'):
-    for key in props:
+    keys = sorted(props) if sort_keys else props
+    for key in keys:
       w.write_property(key, props[key])
   else:
+    if sort_keys:
+      props = _sorted_pairs(props, sort_buffer_size)
     for key, value in props:
       w.write_property(key, value)
 
@@ -92,7 +181,100 @@ def write_property(fh, key, value):
   _property_writer(fh).write_property(key, value)
 
 
-def iter_properties(fh, comments=False):
+def store_many(fh, keys, values, trusted=False, escaped=False):
+  """
+    Writes properties from separate columns of keys and values, for writing
+    many rows quickly.
+
+    Rows are escaped and written in batches, with one pass over each column
+    of a batch rather than one per property, which makes this several times
+    faster than ``store_properties`` for large exports. Unlike
+    ``store_properties`` no comments are written.
+
+    :param fh: a writable file-like object
+    :param keys: an iterable of key strings
+    :param values: an iterable of value strings, the same length as ``keys``
+    :param trusted: skip checking that keys and values are strings, for data
+      that is known to be text
+    :param escaped: keys and values are already escaped for properties files,
+      so they're written as they are
+  """
+  text = _is_text_file(fh)
+  keys = iter(keys)
+  values = iter(values)
+
+  while True:
+    batch_keys = list(itertools.islice(keys, _STORE_MANY_BATCH_SIZE))
+    batch_values = list(itertools.islice(values, _STORE_MANY_BATCH_SIZE))
+    if len(batch_keys) != len(batch_values):
+      raise ValueError('keys and values must be the same length')
+    if not batch_keys:
+      return
+
+    if not trusted:
+      batch_keys = _require_strings(batch_keys, 'keys')
+      batch_values = _require_strings(batch_values, 'values')
+    if not escaped:
+      batch_keys = _escape_keys(batch_keys)
+      batch_values = _escape_values(batch_values)
+
+    chunk = u'\n'.join(map(u'='.join, zip(batch_keys, batch_values))) + u'\n'
+    if text:
+      fh.write(chunk)
+    else:
+      # escaped keys and values can't contain newlines, so only the line
+      # separators are left unescaped
+      chunk = _replace_unicode_escapes(chunk)
+      fh.write(chunk.encode('latin-1'))
+
+
+def open_properties(path, mode='r', compression='auto'):
+  """
+    Opens a properties file in binary mode, transparently handling compression.
+
+    When reading with ``compression='auto'`` the compression is detected from
+    the magic bytes at the start of the file, and when writing it is chosen by
+    the file extension (``.gz``, ``.bz2``, ``.xz`` or ``.zst``). Data is
+    decompressed or compressed incrementally in large blocks, so the whole file
+    is never held in memory.
+
+    ``zstd`` requires Python 3.14's ``compression.zstd`` or the ``zstandard``
+    package.
+
+    Returns a binary file object to use with ``load_properties``,
+    ``store_properties`` and the other functions.
+
+    :param path: path of the file to open
+    :param mode: ``'r'`` to read or ``'w'`` to write (default: ``'r'``)
+    :param compression: ``'gzip'``, ``'bz2'``, ``'xz'``, ``'zstd'``, `None` for
+      an uncompressed file, or ``'auto'`` to detect it (default: ``'auto'``)
+  """
+  mode = mode.replace('b', '')
+  if mode not in ('r', 'w'):
+    raise ValueError("mode must be 'r' or 'w', but got: %r" % (mode,))
+
+  if compression == 'auto':
+    if mode == 'r':
+      compression = _sniff_compression(path)
+    else:
+      compression = _compression_for_path(path)
+
+  if compression is None:
+    return io.open(path, mode + 'b', buffering=_BLOCK_SIZE)
+
+  try:
+    opener = _COMPRESSION_OPENERS[compression]
+  except KeyError:
+    raise ValueError('unsupported compression: %r' % (compression,))
+
+  fp = opener(path, mode)
+  if mode == 'r':
+    return io.BufferedReader(fp, buffer_size=_BLOCK_SIZE)
+  else:
+    return io.BufferedWriter(fp, buffer_size=_BLOCK_SIZE)
+
+
+def iter_properties(fh, comments=False, encoding=None, locations=False):
   """
     Incrementally read properties from a Java .properties file.
 
@@ -101,10 +283,96 @@ def iter_properties(fh, comments=False):
     If ``comments`` is `True`, comments will be included with ``jprops.COMMENT``
     in place of the key.
 
+    If ``locations`` is `True`, tuples of key, value and ``jprops.Location`` are
+    yielded instead, with the first and last physical line numbers of each
+    property and the offset of its first line. Offsets are in bytes for binary
+    files, or characters for text files. Tracking locations is slower, so it's
+    off by default.
+
+    Binary files are decoded as latin-1 by default, like Java's
+    ``Properties.load(InputStream)``. If an ``encoding`` is given, a byte order
+    mark at the start of the file takes precedence over it, and with
+    ``'utf-8'`` the file falls back to latin-1 if it isn't valid UTF-8, like
+    Java's ``PropertyResourceBundle``. Files opened in text mode are already
+    decoded, so the ``encoding`` is ignored.
+
     :param fh: a readable file-like object
     :param comments: should include comments (default: False)
+    :param encoding: encoding of a binary file (default: latin-1)
+    :param locations: should include locations (default: False)
+  """
+  if locations:
+    return _iter_located_properties(fh, comments, encoding)
+  return _iter_properties(fh, comments, encoding)
+
+
+Location = _record_type('Location', ('start_line', 'end_line', 'offset'))
+
+
+class PropertyLocations(Mapping):
   """
-  for line in _property_lines(fh):
+    Compact table of where each property was read from, mapping keys to
+    ``jprops.Location`` tuples.
+
+    Locations are stored in arrays rather than as objects, so keeping them for
+    large files is cheap. Pass this to ``load_properties`` to fill it in::
+
+      locations = jprops.PropertyLocations()
+      props = jprops.load_properties(fp, locations=locations)
+      locations['key'].start_line
+  """
+
+  def __init__(self):
+    import array
+    self._rows = {}
+    self._start_lines = array.array('I')
+    self._end_lines = array.array('I')
+    self._offsets = _offset_array()
+
+  def add(self, key, location):
+    """
+      Records the location of a key, replacing any earlier location, since
+      later properties replace earlier ones with the same key.
+    """
+    start_line, end_line, offset = location
+    row = self._rows.get(key)
+    if row is None:
+      self._rows[key] = len(self._start_lines)
+      self._start_lines.append(start_line)
+      self._end_lines.append(end_line)
+      self._offsets.append(offset)
+    else:
+      self._start_lines[row] = start_line
+      self._end_lines[row] = end_line
+      self._offsets[row] = offset
+
+  def __getitem__(self, key):
+    row = self._rows[key]
+    return Location(
+      self._start_lines[row],
+      self._end_lines[row],
+      int(self._offsets[row]),
+    )
+
+  def __iter__(self):
+    return iter(self._rows)
+
+  def __len__(self):
+    return len(self._rows)
+
+
+def _offset_array():
+  # file offsets need 64 bits, but Python 2's array has no "Q" type code, so
+  # fall back to doubles, which hold offsets up to 2**53 exactly
+  import array
+  try:
+    return array.array('Q')
+  except ValueError:
+    return array.array('d')
+
+
+def _iter_properties(fh, comments, encoding):
+  for line in _property_lines(fh, encoding):
     key, value = _split_key_value(line)
     if key is not COMMENT:
       key = _unescape(key)
@@ -113,17 +381,43 @@ def iter_properties(fh, comments=False):
     yield key, _unescape(value)
 
 
+def _iter_located_properties(fh, comments, encoding):
+  if not _is_text_file(fh):
+    encoding = _resolve_encoding(fh, encoding)
+  for line, location in _located_property_lines(fh, encoding):
+    key, value = _split_key_value(line)
+    if key is not COMMENT:
+      key = _unescape(key)
+    elif not comments:
+      continue
+    yield key, _unescape(value), location
+
+
+def _record_locations(props, locations):
+  for key, value, location in props:
+    locations.add(key, location)
+    yield key, value
+
+
 ################################################################################
 # Helpers for property parsing/writing
 ################################################################################
 
 
 _COMMENT_CHARS = u'#!'
-_LINE_PATTERN = re.compile(r'^\s*(?P<body>.*?)(?P<backslashes>\\*)$')
+_LINE_PATTERN = _LazyPattern(
+  '_LINE_PATTERN', r'^\s*(?P<body>.*?)(?P<backslashes>\\*)$')
+_WHITESPACE = u' \t\n\r\x0b\x0c' # string.whitespace
 _KEY_TERMINATORS_EXPLICIT = u'=:'
-_KEY_TERMINATORS = _KEY_TERMINATORS_EXPLICIT + string.whitespace
-_COMMENT_UNICODE_ESCAPE = re.compile(u'[\u0100-\uffff]')
-_PROPERTY_UNICODE_ESCAPE = re.compile(u'[\u0000-\u0019\u007f-\uffff]')
+_KEY_TERMINATORS = _KEY_TERMINATORS_EXPLICIT + _WHITESPACE
+_COMMENT_UNICODE_ESCAPE = _LazyPattern(
+  '_COMMENT_UNICODE_ESCAPE', u'[\u0100-\uffff]')
+_PROPERTY_UNICODE_ESCAPE = _LazyPattern(
+  '_PROPERTY_UNICODE_ESCAPE', u'[\u0000-\u0019\u007f-\uffff]')
+_UNICODE_ESCAPE = _LazyPattern(
+  '_UNICODE_ESCAPE', r'(\\+)u([0-9a-fA-F]{4})')
+_BACKSLASH_ESCAPE = _LazyPattern('_BACKSLASH_ESCAPE', r'\\(.)')
+_COMMENT_NEWLINE = _LazyPattern('_COMMENT_NEWLINE', r'\n(?![#!])')
 
 
 _escapes = {
@@ -132,9 +426,17 @@ _escapes = {
   'f': '\f',
   'r': '\r',
 }
-_escapes_rev = dict((v, '\\' + k) for k,v in _escapes.items())
-for c in '\\' + _COMMENT_CHARS + _KEY_TERMINATORS_EXPLICIT:
-  _escapes_rev.setdefault(c, '\\' + c)
+_escapes_rev = {
+  '\t': '\\t',
+  '\n': '\\n',
+  '\f': '\\f',
+  '\r': '\\r',
+  '\\': '\\\\',
+  '#': '\\#',
+  '!': '\\!',
+  '=': '\\=',
+  ':': '\\:',
+}
 
 
 def _unescape(value):
@@ -153,13 +455,13 @@ def _unescape(value):
 
     return backslashes + c
 
-  value = re.sub(r'(\\+)u([0-9a-fA-F]{4})', unirepl, value)
+  value = _UNICODE_ESCAPE.sub(unirepl, value)
 
   def bslashrepl(m):
     code = m.group(1)
     return _escapes.get(code, code)
 
-  value = re.sub(r'\\(.)', bslashrepl, value)
+  value = _BACKSLASH_ESCAPE.sub(bslashrepl, value)
 
   # if not native string (e.g. PY2) try converting it back
   if not isinstance(value, str):
@@ -174,7 +476,7 @@ def _unescape(value):
 
 def _escape_comment(comment):
   comment = comment.replace('\r\n', '\n').replace('\r', '\n')
-  comment = re.sub(r'\n(?![#!])', '\n#', comment)
+  comment = _COMMENT_NEWLINE.sub('\n#', comment)
   return u'#' + comment
 
 
@@ -193,20 +495,28 @@ def _escape_value(value):
     head = value
 
   # escape any leading whitespace, but leave other spaces intact
-  return _escape(head, string.whitespace) + _escape(tail)
+  return _escape(head, _WHITESPACE) + _escape(tail)
+
+
+_escape_patterns = {}
 
 
 def _escape(value, chars=''):
-  escape_chars = set(_escapes_rev)
-  escape_chars.update(chars)
-  escape_pattern = '[%s]' % re.escape(''.join(escape_chars))
+  escape_pattern = _escape_patterns.get(chars)
+  if escape_pattern is None:
+    import re
+    escape_chars = set(_escapes_rev)
+    escape_chars.update(chars)
+    escape_pattern = re.compile(
+      '[%s]' % re.escape(''.join(sorted(escape_chars))))
+    _escape_patterns[chars] = escape_pattern
 
-  def esc(m):
-    c = m.group(0)
-    return _escapes_rev.get(c) or '\\' + c
-  value = re.sub(escape_pattern, esc, value)
+  return escape_pattern.sub(_escape_char, value)
 
-  return value
+
+def _escape_char(m):
+  c = m.group(0)
+  return _escapes_rev.get(c) or '\\' + c
 
 
 def _unicode_replace(m):
@@ -247,16 +557,129 @@ def _is_text_file(fp):
   )
 
 
-def _read_lines(fp):
-  lines = iter(fp)
+def _read_lines(fp, encoding=None):
+  blocks = _read_blocks(fp)
   if not _is_text_file(fp):
-    lines = (line.decode('latin-1') for line in lines)
+    blocks = _decode_blocks(blocks, _resolve_encoding(fp, encoding))
+  return _universal_newlines(_line_chunks(blocks))
+
+
+_BOMS = [
+  # UTF-32 is checked first since its little-endian BOM starts with UTF-16's
+  (codecs.BOM_UTF32_LE, 'utf-32-le'),
+  (codecs.BOM_UTF32_BE, 'utf-32-be'),
+  (codecs.BOM_UTF8, 'utf-8'),
+  (codecs.BOM_UTF16_LE, 'utf-16-le'),
+  (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+
+def _detect_bom(data):
+  for bom, encoding in _BOMS:
+    if data.startswith(bom):
+      return encoding, len(bom)
+  return None, 0
+
+
+def _read_blocks(fp):
+  read = getattr(fp, 'read', None)
+  if read is None:
+    # plain iterables are read line-by-line instead
+    return iter(fp)
+  return iter(lambda: read(_BLOCK_SIZE) or None, None)
+
+
+def _detect_encoding(first, encoding=None):
+  # returns the encoding, the encoding to fall back to if it's invalid, and the
+  # first block with any byte order mark removed
+  if encoding is None:
+    return 'latin-1', None, first
+
+  bom_encoding, bom_length = _detect_bom(first)
+  if bom_encoding is not None:
+    return bom_encoding, None, first[bom_length:]
+
+  if codecs.lookup(encoding).name == 'utf-8':
+    return encoding, 'latin-1', first
+  return encoding, None, first
+
+
+def _resolve_encoding(fp, encoding=None):
+  # Java reads the whole file again as latin-1 if it isn't valid UTF-8, so
+  # seekable files are checked up front and rewound, leaving _decode_blocks'
+  # fallback for streams which can only be read once
+  if encoding is None or codecs.lookup(encoding).name != 'utf-8':
+    return encoding
+  seekable = getattr(fp, 'seekable', None)
+  if seekable is None or not seekable():
+    return encoding
+
+  start = fp.tell()
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  try:
+    for idx, block in enumerate(_read_blocks(fp)):
+      if idx == 0 and _detect_bom(block)[0] is not None:
+        # a byte order mark takes precedence, without any fallback
+        return encoding
+      decoder.decode(block)
+    decoder.decode(b'', True)
+  except UnicodeDecodeError:
+    return 'latin-1'
+  finally:
+    fp.seek(start)
+  return encoding
+
+
+def _decode_blocks(blocks, encoding=None, keep_bom=False):
+  first = next(blocks, b'')
+  length = len(first)
+  encoding, fallback, first = _detect_encoding(first, encoding)
+  if keep_bom and len(first) != length:
+    yield u'\ufeff'
+
+  decoder = codecs.getincrementaldecoder(encoding)()
+  for block in itertools.chain([first], blocks, [None]):
+    final = block is None
+    if final:
+      block = b''
+
+    if fallback is None:
+      yield decoder.decode(block, final)
+      continue
+
+    undecoded = decoder.getstate()[0]
+    try:
+      yield decoder.decode(block, final)
+    except UnicodeDecodeError:
+      # not valid UTF-8 so decode the rest of the stream as latin-1. Unlike
+      # Java, which decodes the whole file again, blocks before this one have
+      # already been decoded as UTF-8; see _resolve_encoding for files
+      decoder = codecs.getincrementaldecoder(fallback)()
+      fallback = None
+      yield decoder.decode(undecoded + block, final)
+
+
+def _line_chunks(blocks):
+  # join blocks of text into chunks which end on a line boundary, without the
+  # final newline, so that _universal_newlines yields exactly one item per line
+  pending = u''
+  for text in blocks:
+    text = pending + text
+
+    # hold back a trailing "\r" in case the next block starts with "\n"
+    end = len(text) - 1 if text.endswith(u'\r') else len(text)
+    cut = max(text.rfind(u'\n', 0, end), text.rfind(u'\r', 0, end))
+    if cut < 0:
+      pending = text
+      continue
 
-  # if file was not opened with universal newline support convert the newlines
-  if 'U' not in getattr(fp, 'mode', ''):
-    lines = _universal_newlines(lines)
+    pending = text[cut+1:]
+    if text[cut] == u'\n' and text[cut-1:cut] == u'\r':
+      cut -= 1
+    yield text[:cut]
 
-  return lines
+  if pending:
+    yield pending
 
 
 def _universal_newlines(lines):
@@ -266,9 +689,92 @@ def _universal_newlines(lines):
       yield piece
 
 
-def _property_lines(fp):
+_BLOCK_SIZE = 64 * 1024
+
+_COMPRESSION_MAGIC = [
+  (b'\x1f\x8b', 'gzip'),
+  (b'BZh', 'bz2'),
+  (b'\xfd7zXZ\x00', 'xz'),
+  (b'\x28\xb5\x2f\xfd', 'zstd'),
+]
+
+_COMPRESSION_EXTENSIONS = {
+  '.gz': 'gzip',
+  '.gzip': 'gzip',
+  '.bz2': 'bz2',
+  '.xz': 'xz',
+  '.zst': 'zstd',
+}
+
+
+def _sniff_compression(path):
+  with io.open(path, 'rb') as fp:
+    head = fp.read(6)
+  for magic, compression in _COMPRESSION_MAGIC:
+    if head.startswith(magic):
+      return compression
+  return None
+
+
+def _compression_for_path(path):
+  ext = path[path.rfind('.'):].lower() if '.' in path else ''
+  return _COMPRESSION_EXTENSIONS.get(ext)
+
+
+def _open_gzip(path, mode):
+  import gzip
+  return gzip.GzipFile(path, mode + 'b')
+
+
+def _open_bz2(path, mode):
+  import bz2
+  return bz2.BZ2File(path, mode + 'b')
+
+
+def _open_xz(path, mode):
+  try:
+    import lzma
+  except ImportError:
+    raise ValueError('xz compression requires the lzma module')
+  return lzma.LZMAFile(path, mode + 'b')
+
+
+def _open_zstd(path, mode):
+  try:
+    from compression import zstd
+  except ImportError:
+    pass
+  else:
+    return zstd.ZstdFile(path, mode + 'b')
+
+  try:
+    import zstandard
+  except ImportError:
+    raise ValueError('zstd compression requires the zstandard package')
+
+  fp = io.open(path, mode + 'b')
+  if mode == 'r':
+    return zstandard.ZstdDecompressor().stream_reader(fp, closefd=True)
+  else:
+    return zstandard.ZstdCompressor().stream_writer(fp, closefd=True)
+
+
+_COMPRESSION_OPENERS = {
+  'gzip': _open_gzip,
+  'bz2': _open_bz2,
+  'xz': _open_xz,
+  'zstd': _open_zstd,
+}
+
+
+def _property_lines(fp, encoding=None):
+  return _logical_lines(_read_lines(fp, encoding))
+
+
+def _logical_lines(lines):
+  # joins physical lines continued with a backslash, skipping blank lines
   buf = io.StringIO()
-  for line in _read_lines(fp):
+  for line in lines:
     m = _LINE_PATTERN.match(line)
 
     body = m.group('body')
@@ -291,6 +797,183 @@ def _property_lines(fp):
       buf = io.StringIO()
 
 
+_BYTES_NEWLINE = _LazyPattern('_BYTES_NEWLINE', b'\r\n|\r|\n')
+_TEXT_NEWLINE = _LazyPattern('_TEXT_NEWLINE', u'\r\n|\r|\n')
+
+
+def _split_lines(blocks, newline, cr):
+  # split blocks into physical lines, yielding the offset of each line too
+  offset = 0
+  pending = None
+  for block in blocks:
+    data = block if pending is None else pending + block
+    pos = 0
+    for m in newline.finditer(data):
+      if m.end() == len(data) and data.endswith(cr):
+        # hold back a trailing "\r" in case the next block starts with "\n"
+        break
+      yield offset + pos, data[pos:m.start()]
+      pos = m.end()
+    offset += pos
+    pending = data[pos:]
+
+  if pending:
+    if pending.endswith(cr):
+      pending = pending[:-1]
+    yield offset, pending
+
+
+def _located_lines(fp, encoding=None):
+  blocks = _read_blocks(fp)
+  if _is_text_file(fp):
+    return _split_lines(blocks, _TEXT_NEWLINE, u'\r')
+
+  # the encoding has already been checked with _resolve_encoding
+  first = next(blocks, b'')
+  detected = _detect_encoding(first, encoding)[0]
+  if codecs.lookup(detected).name.startswith(('utf-16', 'utf-32')):
+    raise ValueError('locations cannot be tracked for %s encoded files'
+                     % (detected,))
+
+  # the blocks are decoded exactly as _read_lines does, so the values are the
+  # same, and since newlines are the same bytes in the remaining encodings the
+  # byte offsets of the raw lines match the decoded lines one to one
+  raw, text = itertools.tee(itertools.chain([first], blocks))
+  offsets = (offset for offset, _ in _split_lines(raw, _BYTES_NEWLINE, b'\r'))
+  lines = _universal_newlines(_line_chunks(_decode_blocks(text, encoding)))
+  return izip(offsets, lines)
+
+
+def _located_property_lines(fp, encoding=None):
+  # like _property_lines, but also yields the location of each property, which
+  # is slower so it's kept separate from the default path
+  buf = io.StringIO()
+  start = None
+  for line_no, (offset, line) in enumerate(_located_lines(fp, encoding), 1):
+    m = _LINE_PATTERN.match(line)
+
+    body = m.group('body')
+    backslashes = m.group('backslashes')
+
+    if len(backslashes) % 2 == 0:
+      body += backslashes
+      continuation = False
+    else:
+      body += backslashes[:-1]
+      continuation = True
+
+    if not body:
+      continue
+
+    if start is None:
+      start = line_no, offset
+    buf.write(body)
+
+    if not continuation:
+      start_line, start_offset = start
+      yield buf.getvalue(), Location(start_line, line_no, start_offset)
+      buf = io.StringIO()
+      start = None
+
+
+def _pair_key(pair):
+  return pair[0]
+
+
+def _sorted_pairs(pairs, buffer_size=None):
+  if buffer_size is None:
+    return iter(sorted(pairs, key=_pair_key))
+  if buffer_size < 1:
+    raise ValueError('sort_buffer_size must be at least 1, but got: %r'
+                     % (buffer_size,))
+  return _external_sorted_pairs(pairs, buffer_size)
+
+
+def _external_sorted_pairs(pairs, buffer_size):
+  checked = (
+    (_require_string(key, 'keys'), _require_string(value, 'values'))
+    for key, value in pairs
+  )
+  return _external_sorted(checked, buffer_size, _pair_key)
+
+
+def _external_sorted(items, buffer_size, key=None):
+  # stably sorts items holding at most buffer_size of them in memory, spilling
+  # sorted runs to temporary files and merging them
+  import heapq
+  import itertools
+  import marshal
+  import struct
+  import tempfile
+
+  items = iter(items)
+  runs = []
+  try:
+    while True:
+      chunk = sorted(itertools.islice(items, buffer_size), key=key)
+      if not chunk:
+        break
+      if not runs and len(chunk) < buffer_size:
+        # everything fit in memory, so there's no need to spill to disk
+        for item in chunk:
+          yield item
+        return
+
+      # spill the sorted run as marshalled lists of items, which read back
+      # exactly as they were written, unlike the properties format
+      run = tempfile.TemporaryFile()
+      runs.append(run)
+      for start in range(0, len(chunk), _SPILL_BATCH_SIZE):
+        # marshal.load reads files in tiny pieces, so batches are written
+        # with their length to be read in one go
+        data = marshal.dumps(chunk[start:start + _SPILL_BATCH_SIZE])
+        run.write(struct.pack('<I', len(data)))
+        run.write(data)
+      del chunk
+      run.seek(0)
+
+    if key is None:
+      # equal items are interchangeable, so they can be merged directly
+      for item in heapq.merge(*[_read_run(run) for run in runs]):
+        yield item
+      return
+
+    # decorate each item with its run number so equal keys keep their
+    # original order, since heapq.merge in Python 2 doesn't take a key function
+    merged = heapq.merge(*[
+      _numbered_run(idx, run, key) for idx, run in enumerate(runs)
+    ])
+    for _, _, item in merged:
+      yield item
+  finally:
+    for run in runs:
+      run.close()
+
+
+_SPILL_BATCH_SIZE = 1024
+
+
+def _read_run(run):
+  return itertools.chain.from_iterable(_run_batches(run))
+
+
+def _run_batches(run):
+  import marshal
+  import struct
+
+  while True:
+    header = run.read(4)
+    if not header:
+      return
+    size, = struct.unpack('<I', header)
+    yield marshal.loads(run.read(size))
+
+
+def _numbered_run(idx, run, key):
+  for item in _read_run(run):
+    yield key(item), idx, item
+
+
 def _property_writer(fh):
   if _is_text_file(fh):
     return _TextPropertyWriter(fh)
@@ -311,6 +994,77 @@ def _require_string(value, name):
                   % (name, valid_types, type(value), value))
 
 
+def _require_strings(values, name):
+  for cls in set(map(type, values)):
+    if not issubclass(cls, text_type):
+      return [_require_string(value, name) for value in values]
+  return values
+
+
+_STORE_MANY_BATCH_SIZE = 4096
+_STORE_MANY_SEPARATOR = u'\x00'
+_STORE_MANY_MAX_REPLACES = 32
+_STORE_MANY_UNICODE_ESCAPE = _LazyPattern(
+  '_STORE_MANY_UNICODE_ESCAPE', u'[\u0000-\u0009\u000b-\u0019\u007f-\uffff]')
+_LEADING_WHITESPACE = _LazyPattern(
+  '_LEADING_WHITESPACE', u'(?:^|\x00)[%s]' % _WHITESPACE)
+
+
+def _escape_keys(keys):
+  joined = _join_column(keys)
+  if joined is None:
+    return [_escape_key(key) for key in keys]
+  return _replace_escapes(joined, _KEY_TERMINATORS).split(
+    _STORE_MANY_SEPARATOR)
+
+
+def _escape_values(values):
+  joined = _join_column(values)
+  if joined is None:
+    return [_escape_value(value) for value in values]
+
+  escaped = _replace_escapes(joined).split(_STORE_MANY_SEPARATOR)
+  if _LEADING_WHITESPACE.search(joined):
+    for idx, value in enumerate(values):
+      if value and value[0] in _WHITESPACE:
+        escaped[idx] = _escape_value(value)
+  return escaped
+
+
+def _join_column(column):
+  # a column is escaped all at once by joining it with a separator, escaping
+  # it as one string and splitting it again, unless the separator appears in
+  # the data
+  joined = _STORE_MANY_SEPARATOR.join(column)
+  if joined.count(_STORE_MANY_SEPARATOR) != len(column) - 1:
+    return None
+  return joined
+
+
+def _replace_escapes(value, chars=''):
+  # like _escape, but with one str.replace per character, which is much faster
+  # than a regex substitution for a long string with many escapes
+  value = value.replace(u'\\', u'\\\\')
+  for c in set(_escapes_rev).union(chars):
+    if c != u'\\' and c in value:
+      value = value.replace(c, _escapes_rev.get(c) or u'\\' + c)
+  return value
+
+
+def _replace_unicode_escapes(value):
+  # like _PROPERTY_UNICODE_ESCAPE.sub, but with one str.replace per distinct
+  # character, falling back to the regex for text with too many of them
+  pattern = _STORE_MANY_UNICODE_ESCAPE
+  m = pattern.search(value)
+  for _ in range(_STORE_MANY_MAX_REPLACES):
+    if m is None:
+      return value
+    c = m.group(0)
+    value = value.replace(c, _unicode_replace(m))
+    m = pattern.search(value, m.start())
+  return pattern.sub(_unicode_replace, value)
+
+
 class _TextPropertyWriter(object):
   _escape_comment = staticmethod(_escape_comment)
   _escape_key = staticmethod(_escape_key)
@@ -360,3 +1114,2083 @@ class _BytesPropertyWriter(_TextPropertyWriter):
   def _escape_value(self, value):
     value = _TextPropertyWriter._escape_value(value)
     return _PROPERTY_UNICODE_ESCAPE.sub(_unicode_replace, value)
+
+
+################################################################################
+# Typed access to property values
+################################################################################
+
+
+class PropertyValueError(ValueError):
+  """
+    Raised when a property value cannot be converted to the requested type.
+
+    The ``key``, ``value``, ``type_name`` and ``line`` attributes describe the
+    invalid property, where ``line`` is `None` if the line number is unknown.
+  """
+  def __init__(self, key, value, type_name, line=None):
+    self.key = key
+    self.value = value
+    self.type_name = type_name
+    self.line = line
+
+    location = '' if line is None else ' on line %d' % line
+    ValueError.__init__(self, 'invalid %s value for %r%s: %r'
+                        % (type_name, key, location, value))
+
+
+class TypedProperties(Mapping):
+  """
+    Read-only view of properties which converts values to Python types.
+
+    A ``schema`` maps keys to the type of their values. Types can be given as
+    ``'str'``, ``'int'``, ``'float'``, ``'bool'``, ``'duration'`` or ``'list'``,
+    the equivalent built-in types, or any function taking the string value.
+    Looking up a key in the schema returns the converted value, while other
+    keys return the original string.
+
+    The typed getters such as ``get_int`` convert any key regardless of the
+    schema. Each conversion is done once and cached per key.
+
+    If a value cannot be converted, a ``PropertyValueError`` is raised which
+    includes the line number if the properties were read with
+    ``TypedProperties.load`` or ``lines`` was given.
+
+    :param props: a mapping of the properties' string values
+    :param schema: a mapping of keys to types
+    :param lines: a mapping of keys to the line number they were read from
+  """
+
+  def __init__(self, props, schema=None, lines=None):
+    self._props = props
+    self._schema = _resolve_schema(schema)
+    self._lines = lines if lines is not None else {}
+    self._cache = {}
+
+  @classmethod
+  def load(cls, fh, schema=None, encoding=None):
+    """
+      Reads properties from a Java .properties file, recording the line
+      numbers to report in conversion errors.
+
+      :param fh: a readable file-like object
+      :param schema: a mapping of keys to types
+      :param encoding: encoding of a binary file (default: latin-1)
+    """
+    props = {}
+    lines = {}
+    located = iter_properties(fh, encoding=encoding, locations=True)
+    for key, value, location in located:
+      props[key] = value
+      lines[key] = location.start_line
+    return cls(props, schema, lines)
+
+  def __getitem__(self, key):
+    converter = self._schema.get(key)
+    if converter is None:
+      return self._props[key]
+    return self._convert(key, converter)
+
+  def __iter__(self):
+    return iter(self._props)
+
+  def __len__(self):
+    return len(self._props)
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, self._props)
+
+  def line(self, key):
+    """
+      Returns the line number the key was read from, or `None` if unknown.
+    """
+    return self._lines.get(key)
+
+  def get_str(self, key, default=None):
+    return self._get(key, 'str', default)
+
+  def get_int(self, key, default=None):
+    return self._get(key, 'int', default)
+
+  def get_float(self, key, default=None):
+    return self._get(key, 'float', default)
+
+  def get_bool(self, key, default=None):
+    """
+      Converts ``true``, ``yes``, ``on`` or ``1`` to `True` and ``false``,
+      ``no``, ``off`` or ``0`` to `False`, ignoring case.
+    """
+    return self._get(key, 'bool', default)
+
+  def get_duration(self, key, default=None):
+    """
+      Converts a duration to a ``datetime.timedelta``. Durations are a number
+      of seconds, or numbers with units of ``ms``, ``s``, ``m``, ``h`` or ``d``
+      such as ``250ms`` or ``1h30m``.
+    """
+    return self._get(key, 'duration', default)
+
+  def get_list(self, key, default=None):
+    """
+      Converts a comma-separated value to a list of stripped strings.
+    """
+    return self._get(key, 'list', default)
+
+  def bulk_convert(self, schema=None):
+    """
+      Converts every key in the schema at once, returning a dict of the
+      converted values. Keys in the schema which are missing from the
+      properties are left out.
+
+      :param schema: a mapping of keys to types (default: the view's schema)
+    """
+    if schema is None:
+      converters = self._schema
+    else:
+      converters = _resolve_schema(schema)
+
+    props = self._props
+    convert = self._convert
+    return dict(
+      (key, convert(key, converter))
+      for key, converter in converters.items()
+      if key in props
+    )
+
+  def _get(self, key, type_name, default):
+    if key not in self._props:
+      return default
+    return self._convert(key, _CONVERTERS[type_name])
+
+  def _convert(self, key, converter):
+    cache_key = (key, converter)
+    try:
+      return self._cache[cache_key]
+    except KeyError:
+      pass
+
+    value = self._props[key]
+    type_name, convert = converter
+    try:
+      result = convert(value)
+    except (TypeError, ValueError, OverflowError):
+      # durations too large for a timedelta raise OverflowError
+      raise PropertyValueError(key, value, type_name, self._lines.get(key))
+
+    self._cache[cache_key] = result
+    return result
+
+
+_BOOLEANS = {
+  'true': True, 'yes': True, 'on': True, '1': True,
+  'false': False, 'no': False, 'off': False, '0': False,
+}
+_DURATION_PART = _LazyPattern(
+  '_DURATION_PART', r'(\d+(?:\.\d*)?|\.\d+)\s*(ms|s|m|h|d)\s*')
+_DURATION_UNITS = {
+  'ms': 0.001,
+  's': 1,
+  'm': 60,
+  'h': 60 * 60,
+  'd': 24 * 60 * 60,
+}
+
+
+def _to_str(value):
+  return value
+
+
+def _to_bool(value):
+  try:
+    return _BOOLEANS[value.strip().lower()]
+  except KeyError:
+    raise ValueError('invalid boolean: %r' % (value,))
+
+
+def _to_duration(value):
+  import datetime
+
+  value = value.strip()
+  try:
+    return datetime.timedelta(seconds=float(value))
+  except ValueError:
+    pass
+
+  seconds = 0
+  pos = 0
+  while pos < len(value):
+    m = _DURATION_PART.match(value, pos)
+    if m is None:
+      raise ValueError('invalid duration: %r' % (value,))
+    seconds += float(m.group(1)) * _DURATION_UNITS[m.group(2)]
+    pos = m.end()
+
+  if not pos:
+    raise ValueError('invalid duration: %r' % (value,))
+  return datetime.timedelta(seconds=seconds)
+
+
+def _to_list(value):
+  if not value.strip():
+    return []
+  return [item.strip() for item in value.split(',')]
+
+
+_CONVERTERS = {
+  'str': ('str', _to_str),
+  'int': ('int', int),
+  'float': ('float', float),
+  'bool': ('bool', _to_bool),
+  'duration': ('duration', _to_duration),
+  'list': ('list', _to_list),
+}
+_CONVERTER_TYPES = {
+  str: 'str',
+  text_type: 'str',
+  int: 'int',
+  float: 'float',
+  bool: 'bool',
+  list: 'list',
+}
+
+
+def _resolve_converter(spec):
+  if isinstance(spec, string_types):
+    try:
+      return _CONVERTERS[spec]
+    except KeyError:
+      raise ValueError('unknown property type: %r' % (spec,))
+
+  try:
+    return _CONVERTERS[_CONVERTER_TYPES[spec]]
+  except (KeyError, TypeError):
+    pass
+
+  if not callable(spec):
+    raise TypeError('property types must be a type name or callable, but got: '
+                    '%r' % (spec,))
+  return (getattr(spec, '__name__', repr(spec)), spec)
+
+
+def _resolve_schema(schema):
+  if not schema:
+    return {}
+  return dict((key, _resolve_converter(spec)) for key, spec in schema.items())
+
+
+################################################################################
+# Watching files for changes
+################################################################################
+
+
+class WatchedProperties(Mapping):
+  """
+    Properties loaded from a file which are reloaded in a background thread
+    whenever the file changes.
+
+    Changes are detected with inotify where it's available, or otherwise by
+    polling the file's size and modification time every ``interval`` seconds.
+    Reloads wait until the file has stopped changing for ``debounce`` seconds.
+    The new properties replace the old ones all at once, so reads never see a
+    partially loaded file and never need to take a lock.
+
+    The file is read with ``open_properties``, so it may be compressed. If the
+    file can't be read, the previous properties are kept and the error is
+    saved as ``last_error``.
+
+    Use ``close()`` or a ``with`` block to stop watching the file.
+
+    :param path: path of the file to watch
+    :param encoding: encoding of the file (default: latin-1)
+    :param debounce: seconds to wait for the file to stop changing
+    :param interval: seconds between checks when polling for changes
+    :param use_inotify: should use inotify if available (default: True)
+  """
+
+  def __init__(self, path, encoding=None, debounce=0.1, interval=1.0,
+               use_inotify=True):
+    import os
+    import threading
+
+    self.path = os.path.abspath(path)
+    self.encoding = encoding
+    self.debounce = debounce
+    self.interval = interval
+
+    self.reload_count = 0
+    self.last_reload_latency = None
+    self.total_reload_time = 0.0
+    self.last_error = None
+
+    self._callbacks = []
+    self._props = self._load()
+
+    watcher = _InotifyWatcher.create(self.path) if use_inotify else None
+    self._watcher = watcher or _PollingWatcher(self.path)
+
+    self._stop = threading.Event()
+    self._thread = threading.Thread(
+      target=self._run,
+      name='jprops-watch:%s' % self.path,
+    )
+    self._thread.daemon = True
+    self._thread.start()
+
+  def __getitem__(self, key):
+    return self._props[key]
+
+  def __iter__(self):
+    return iter(self._props)
+
+  def __len__(self):
+    return len(self._props)
+
+  def __repr__(self):
+    return '%s(%r)' % (type(self).__name__, self.path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def snapshot(self):
+    """
+      Returns the currently loaded properties as a dict, which won't change
+      when the file is reloaded. It must not be modified.
+    """
+    return self._props
+
+  def on_change(self, callback, keys=None):
+    """
+      Registers a function to call with ``(key, old_value, new_value)`` for
+      each property that changes when the file is reloaded. The old or new
+      value is `None` if the property was added or removed.
+
+      Callbacks run in the background thread.
+
+      :param callback: the function to call
+      :param keys: only call for changes to these keys (default: all keys)
+    """
+    if keys is not None:
+      keys = frozenset(keys)
+    self._callbacks.append((callback, keys))
+
+  def metrics(self):
+    """
+      Returns a dict with the number of reloads, the time taken by the last
+      reload and the total time spent reloading in seconds, and the kind of
+      watcher used (``'inotify'`` or ``'poll'``).
+    """
+    return {
+      'reload_count': self.reload_count,
+      'last_reload_latency': self.last_reload_latency,
+      'total_reload_time': self.total_reload_time,
+      'watcher': self._watcher.name,
+    }
+
+  def reload(self):
+    """
+      Reloads the file immediately, returning `True` if it was loaded.
+    """
+    start = _monotonic()
+    try:
+      props = self._load()
+    except Exception as e:
+      # any error, including EOFError from a half-written compressed file,
+      # must not stop the watcher thread
+      self.last_error = e
+      return False
+
+    old = self._props
+    self._props = props
+
+    latency = _monotonic() - start
+    self.reload_count += 1
+    self.last_reload_latency = latency
+    self.total_reload_time += latency
+    self.last_error = None
+
+    if self._callbacks:
+      self._notify(old, props)
+    return True
+
+  def close(self):
+    """
+      Stops watching the file, keeping the last loaded properties.
+    """
+    if self._stop.is_set():
+      return
+    self._stop.set()
+    self._watcher.wake()
+    self._thread.join()
+    self._watcher.close()
+
+  def _load(self):
+    with open_properties(self.path) as fp:
+      return load_properties(fp, encoding=self.encoding)
+
+  def _run(self):
+    deadline = None
+    while not self._stop.is_set():
+      if deadline is None:
+        timeout = self.interval
+      else:
+        timeout = max(0, deadline - _monotonic())
+
+      if self._watcher.wait(timeout, self._stop):
+        # keep waiting until the file stops changing
+        deadline = _monotonic() + self.debounce
+      elif deadline is not None and _monotonic() >= deadline:
+        deadline = None
+        self.reload()
+
+  def _notify(self, old, new):
+    changed = [
+      key for key in set(old).union(new)
+      if old.get(key) != new.get(key)
+    ]
+    for callback, keys in self._callbacks:
+      for key in changed:
+        if keys is not None and key not in keys:
+          continue
+        try:
+          callback(key, old.get(key), new.get(key))
+        except Exception:
+          import logging
+          logging.getLogger('jprops').exception(
+            'error in change callback for %s', self.path)
+
+
+def _monotonic():
+  import time
+  return getattr(time, 'monotonic', time.time)()
+
+
+def _stat_signature(path):
+  import os
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return st.st_ino, st.st_size, st.st_mtime
+
+
+class _PollingWatcher(object):
+  name = 'poll'
+
+  def __init__(self, path):
+    self.path = path
+    self._signature = _stat_signature(path)
+
+  def wait(self, timeout, stop):
+    if stop.wait(timeout):
+      return False
+    signature = _stat_signature(self.path)
+    changed = signature != self._signature
+    self._signature = signature
+    return changed
+
+  def wake(self):
+    pass
+
+  def close(self):
+    pass
+
+
+class _InotifyWatcher(object):
+  name = 'inotify'
+
+  # watch the directory rather than the file, so that files replaced by
+  # renaming another file over them are still seen
+  _MASK = (
+    0x00000002 # IN_MODIFY
+    | 0x00000004 # IN_ATTRIB
+    | 0x00000008 # IN_CLOSE_WRITE
+    | 0x00000040 # IN_MOVED_FROM
+    | 0x00000080 # IN_MOVED_TO
+    | 0x00000100 # IN_CREATE
+    | 0x00000200 # IN_DELETE
+  )
+  _FLAGS = 0o4000 | 0o2000000 # IN_NONBLOCK | IN_CLOEXEC
+
+  @classmethod
+  def create(cls, path):
+    # returns None if inotify isn't available
+    import os
+    try:
+      import ctypes
+      libc = ctypes.CDLL(None, use_errno=True)
+      inotify_init1 = libc.inotify_init1
+      inotify_add_watch = libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+      return None
+
+    fd = inotify_init1(cls._FLAGS)
+    if fd < 0:
+      return None
+
+    directory, filename = os.path.split(path)
+    directory = directory.encode(sys.getfilesystemencoding())
+    if inotify_add_watch(fd, directory, cls._MASK) < 0:
+      os.close(fd)
+      return None
+
+    return cls(fd, filename)
+
+  def __init__(self, fd, filename):
+    import os
+    self._fd = fd
+    self._filename = filename.encode(sys.getfilesystemencoding())
+    self._wake_r, self._wake_w = os.pipe()
+
+  def wait(self, timeout, stop):
+    import os
+    import select
+    import struct
+
+    readable = select.select([self._fd, self._wake_r], [], [], timeout)[0]
+    if self._fd not in readable or stop.is_set():
+      return False
+
+    changed = False
+    try:
+      data = os.read(self._fd, 64 * 1024)
+    except OSError:
+      return False
+
+    pos = 0
+    while pos + 16 <= len(data):
+      name_length = struct.unpack_from('iIII', data, pos)[3]
+      name = data[pos+16:pos+16+name_length].rstrip(b'\0')
+      pos += 16 + name_length
+      if name == self._filename:
+        changed = True
+    return changed
+
+  def wake(self):
+    import os
+    os.write(self._wake_w, b'x')
+
+  def close(self):
+    import os
+    for fd in (self._fd, self._wake_r, self._wake_w):
+      os.close(fd)
+
+
+################################################################################
+# Localized resource bundles
+################################################################################
+
+
+class ResourceBundles(object):
+  """
+    Loads localized properties files like Java's ``ResourceBundle``.
+
+    Bundles are loaded from files named ``<basename>_<locale>.properties`` in
+    ``directory``, such as ``messages_fr_CA.properties``, with
+    ``<basename>.properties`` as the base bundle. Each bundle falls back to its
+    parent locale for keys it doesn't define, so ``fr_CA`` falls back to ``fr``,
+    which falls back to the base bundle. Locales without a file use their
+    parent's bundle.
+
+    Bundles are loaded the first time they're used and shared between their
+    child locales. Each bundle only stores the properties that differ from its
+    parent, so keys with the same value in every locale are stored once.
+
+    :param directory: directory containing the properties files
+    :param basename: name of the bundle's files
+    :param encoding: encoding of the files (default: UTF-8 with a latin-1
+      fallback, like Java's ``PropertyResourceBundle``)
+  """
+
+  def __init__(self, directory, basename, encoding='utf-8'):
+    import threading
+    self.directory = directory
+    self.basename = basename
+    self.encoding = encoding
+    self._bundles = {}
+    self._lock = threading.Lock()
+
+  def get_bundle(self, locale=''):
+    """
+      Returns the ``ResourceBundle`` for a locale, such as ``'fr_CA'`` or
+      ``'fr-CA'``. Raises `LookupError` if there are no files for the locale
+      or any of its parents.
+    """
+    locale = _normalize_locale(locale)
+    try:
+      bundle = self._bundles[locale]
+    except KeyError:
+      with self._lock:
+        bundle = self._load(locale)
+
+    if bundle is None:
+      raise LookupError('no resource bundle %r for locale %r in %s'
+                        % (self.basename, locale, self.directory))
+    return bundle
+
+  def _load(self, locale):
+    # must be called with the lock held
+    import os
+
+    if locale in self._bundles:
+      return self._bundles[locale]
+
+    parent = None
+    if locale:
+      parent = self._load(locale.rpartition('_')[0])
+
+    filename = self.basename
+    if locale:
+      filename += '_' + locale
+    path = os.path.join(self.directory, filename + '.properties')
+
+    if os.path.exists(path):
+      with open_properties(path) as fp:
+        props = iter_properties(fp, encoding=self.encoding)
+        bundle = ResourceBundle(locale, props, parent)
+    else:
+      bundle = parent
+
+    self._bundles[locale] = bundle
+    return bundle
+
+
+class ResourceBundle(Mapping):
+  """
+    Read-only mapping of a locale's properties, including those inherited from
+    its parent locales. Bundles are loaded with ``ResourceBundles``.
+  """
+
+  def __init__(self, locale, props, parent=None):
+    self.locale = locale
+    self.parent = parent
+
+    if parent is None:
+      self._own = dict(props)
+    else:
+      # only keep what differs from the parent, the rest is looked up there
+      own = dict(props)
+      for key, value in list(own.items()):
+        if parent.get(key, _MISSING) == value:
+          del own[key]
+      self._own = own
+
+  def __getitem__(self, key):
+    # the chain is at most one bundle for each part of the locale, so lookups
+    # take a small, constant number of dict lookups
+    bundle = self
+    while bundle is not None:
+      try:
+        return bundle._own[key]
+      except KeyError:
+        bundle = bundle.parent
+    raise KeyError(key)
+
+  def __contains__(self, key):
+    bundle = self
+    while bundle is not None:
+      if key in bundle._own:
+        return True
+      bundle = bundle.parent
+    return False
+
+  def __iter__(self):
+    seen = set()
+    bundle = self
+    while bundle is not None:
+      for key in bundle._own:
+        if key not in seen:
+          seen.add(key)
+          yield key
+      bundle = bundle.parent
+
+  def __len__(self):
+    return sum(1 for _ in self)
+
+  def __repr__(self):
+    return '<%s %r>' % (type(self).__name__, self.locale)
+
+
+_MISSING = object()
+
+
+def _normalize_locale(locale):
+  # normalize "fr-ca" or "fr_CA" to Java's "fr_CA" format
+  parts = locale.replace('-', '_').split('_') if locale else []
+  if parts:
+    parts[0] = parts[0].lower()
+  for idx in range(1, len(parts)):
+    part = parts[idx]
+    if len(part) == 2 or (len(part) == 3 and part.isdigit()):
+      # a region such as "CA" or "419"
+      parts[idx] = part.upper()
+    elif len(part) == 4 and part.isalpha():
+      # a script such as "Hant"
+      parts[idx] = part.title()
+  return '_'.join(parts)
+
+
+################################################################################
+# Validation
+################################################################################
+
+
+Diagnostic = _record_type('Diagnostic', ('line', 'code', 'message'))
+
+
+def validate(fh, encoding=None):
+  """
+    Checks a Java .properties file for likely mistakes without loading it.
+
+    Returns a list of ``jprops.Diagnostic`` tuples with the line number, a
+    code, and a message for each problem found. The codes are:
+
+    ``duplicate-key``
+      a key which is defined more than once
+    ``invalid-unicode-escape``
+      a ``\\u`` escape which isn't followed by four hex digits
+    ``continuation-at-eof``
+      a continuation backslash on the last line, which jprops ignores
+    ``continued-comment``
+      a comment ending in a continuation backslash, which makes the next
+      line part of the comment
+    ``non-latin-1``
+      a character that can't be written in Java's default latin-1 encoding
+
+    :param fh: a readable file-like object
+    :param encoding: encoding of a binary file (default: latin-1)
+  """
+  diagnostics = []
+  seen = {}
+  buf = []
+  start = None
+  line_no = 0
+
+  for line_no, line in enumerate(_read_lines(fh, encoding), 1):
+    m = _NON_LATIN_1.search(line)
+    if m is not None:
+      diagnostics.append(Diagnostic(
+        line_no, 'non-latin-1',
+        'character %r is not in latin-1' % (m.group(0),)))
+
+    body = line.lstrip()
+    stripped = body.rstrip(u'\\')
+    continuation = (len(body) - len(stripped)) % 2 == 1
+    if continuation:
+      body = body[:-1]
+    if not body:
+      continue
+
+    if start is None:
+      start = line_no
+      if continuation and body[0] in _COMMENT_CHARS:
+        # comments continue like properties, hiding the next line
+        diagnostics.append(Diagnostic(
+          line_no, 'continued-comment',
+          'comment continues onto the next line'))
+    buf.append(body)
+    if continuation:
+      continue
+
+    _validate_property(u''.join(buf), start, seen, diagnostics)
+    buf = []
+    start = None
+
+  if buf:
+    diagnostics.append(Diagnostic(
+      line_no, 'continuation-at-eof',
+      'line continues past the end of the file'))
+    _validate_property(u''.join(buf), start, seen, diagnostics)
+
+  diagnostics.sort(key=_diagnostic_line)
+  return diagnostics
+
+
+_NON_LATIN_1 = _LazyPattern('_NON_LATIN_1', u'[^\\u0000-\\u00ff]')
+_UNICODE_ESCAPE_PREFIX = _LazyPattern(
+  '_UNICODE_ESCAPE_PREFIX', r'(\\+)u(?![0-9a-fA-F]{4})')
+
+
+def _diagnostic_line(diagnostic):
+  return diagnostic.line
+
+
+def _validate_property(line, line_no, seen, diagnostics):
+  if line[0] in _COMMENT_CHARS:
+    return
+
+  for m in _UNICODE_ESCAPE_PREFIX.finditer(line):
+    if len(m.group(1)) % 2 == 1:
+      diagnostics.append(Diagnostic(
+        line_no, 'invalid-unicode-escape',
+        'malformed \\uxxxx escape: %r' % (line[m.end() - 2:m.end() + 4],)))
+
+  key, _ = _split_key_value(line)
+  key = _unescape(key)
+  first = seen.setdefault(key, line_no)
+  if first != line_no:
+    diagnostics.append(Diagnostic(
+      line_no, 'duplicate-key',
+      'duplicate key %r, first defined on line %d' % (key, first)))
+
+
+################################################################################
+# Sharing properties between processes
+################################################################################
+
+
+def share_properties(props, name=None):
+  """
+    Copies properties into a new shared memory segment, which other processes
+    can attach to with ``attach_properties`` without copying the properties.
+
+    Returns a ``SharedProperties`` mapping of the segment, with the segment's
+    name as ``name``. ``SharedProperties`` can also be pickled to send them to
+    other processes, which attaches to the segment by name. The process that
+    shares the properties should call ``unlink()`` when they are no longer
+    needed.
+
+    Requires Python 3.8 or later.
+
+    :param props: a mapping (dict) or iterable of key/value pairs
+    :param name: name of the shared memory segment (default: a random name)
+  """
+  from multiprocessing import shared_memory
+
+  data = _pack_properties(props)
+  shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+  shm.buf[:len(data)] = data
+  return SharedProperties(shm.buf, shm)
+
+
+def attach_properties(name):
+  """
+    Attaches to properties shared by ``share_properties`` in another process.
+
+    Attaching only reads a small header, and values are read directly from
+    the shared memory when they're looked up, so every process uses the same
+    copy of the properties.
+
+    :param name: name of the shared memory segment
+  """
+  from multiprocessing import shared_memory
+
+  try:
+    shm = shared_memory.SharedMemory(name=name, track=False)
+  except TypeError:
+    # before Python 3.13 attaching registers the segment to be removed when
+    # the process exits, which would remove it for every process
+    shm = _AttachedMemory.open(name) or shared_memory.SharedMemory(name=name)
+  return SharedProperties(shm.buf, shm)
+
+
+class _AttachedMemory(object):
+  # read-only POSIX shared memory which isn't tracked for removal at exit
+
+  @classmethod
+  def open(cls, name):
+    # returns None on platforms without POSIX shared memory
+    try:
+      import _posixshmem
+    except ImportError:
+      return None
+    import mmap
+    import os
+
+    fd = _posixshmem.shm_open('/' + name, os.O_RDONLY)
+    try:
+      mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+      os.close(fd)
+    return cls(name, mapped)
+
+  def __init__(self, name, mapped):
+    self.name = name
+    self._mmap = mapped
+    self.buf = memoryview(mapped)
+
+  def close(self):
+    self.buf.release()
+    self._mmap.close()
+
+  def unlink(self):
+    import _posixshmem
+    _posixshmem.shm_unlink('/' + self.name)
+
+
+class SharedProperties(Mapping):
+  """
+    Read-only mapping of properties packed in shared memory, created with
+    ``share_properties`` or ``attach_properties``.
+
+    Keys are found with a hash table in the shared memory, and values are
+    decoded each time they're looked up.
+  """
+
+  def __init__(self, buffer, shm=None):
+    import struct
+    import zlib
+
+    buf = memoryview(buffer)
+    magic, version, count, table_size = _SHARED_HEADER.unpack_from(buf, 0)
+    if magic != _SHARED_MAGIC or version != _SHARED_VERSION:
+      raise ValueError('not a shared properties buffer')
+
+    self._buf = buf.toreadonly() if hasattr(buf, 'toreadonly') else buf
+    self._shm = shm
+    self._count = count
+    self._mask = table_size - 1
+    self._table = _SHARED_HEADER.size + count * _SHARED_ENTRY.size
+    self._pool = self._table + table_size * 4
+    self._slot = struct.Struct('<I')
+    self._crc32 = zlib.crc32
+
+  @property
+  def name(self):
+    """
+      Name of the shared memory segment, or `None` if not in shared memory.
+    """
+    return self._shm.name if self._shm is not None else None
+
+  def __getitem__(self, key):
+    if not isinstance(key, string_types):
+      raise KeyError(key)
+    encoded = _encode_shared(key)
+    key_hash = self._crc32(encoded) & 0xffffffff
+
+    buf = self._buf
+    pool = self._pool
+    slot = key_hash & self._mask
+    while True:
+      idx = self._slot.unpack_from(buf, self._table + slot * 4)[0]
+      if not idx:
+        raise KeyError(key)
+      entry_hash, key_start, key_end, value_end = self._entry(idx - 1)
+      if (entry_hash == key_hash
+          and buf[pool + key_start:pool + key_end] == encoded):
+        return _decode_shared(buf[pool + key_end:pool + value_end])
+      slot = (slot + 1) & self._mask
+
+  def __iter__(self):
+    buf = self._buf
+    pool = self._pool
+    for idx in range(self._count):
+      _, key_start, key_end, _ = self._entry(idx)
+      yield _decode_shared(buf[pool + key_start:pool + key_end])
+
+  def __len__(self):
+    return self._count
+
+  def __repr__(self):
+    return '<%s %r with %d properties>' % (
+      type(self).__name__, self.name, self._count)
+
+  def __reduce__(self):
+    if self._shm is None:
+      return (SharedProperties, (self._buf.tobytes(),))
+    return (attach_properties, (self._shm.name,))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def close(self):
+    """
+      Detaches from the shared memory. The properties can't be used after
+      they're closed.
+    """
+    self._buf.release()
+    if self._shm is not None:
+      self._shm.close()
+
+  def unlink(self):
+    """
+      Removes the shared memory segment once every process has closed it.
+    """
+    if self._shm is not None:
+      self._shm.unlink()
+
+  def _entry(self, idx):
+    return _SHARED_ENTRY.unpack_from(
+      self._buf, _SHARED_HEADER.size + idx * _SHARED_ENTRY.size)
+
+
+# The packed layout is a header, an array of entries in their original order,
+# an open-addressing hash table of entry numbers (plus 1, so 0 is an empty
+# slot) and a pool of the UTF-8 encoded keys and values. Each entry is the hash
+# of the key and the key start, key end (which is also the value start) and
+# value end offsets into the pool.
+_SHARED_MAGIC = b'JPRP'
+_SHARED_VERSION = 1
+
+
+class _LazyStruct(_LazyPattern):
+  __slots__ = ()
+
+  @staticmethod
+  def _compile(format):
+    import struct
+    return struct.Struct(format)
+
+
+_SHARED_HEADER = _LazyStruct('_SHARED_HEADER', '<4sIII')
+_SHARED_ENTRY = _LazyStruct('_SHARED_ENTRY', '<IIII')
+
+
+def _encode_shared(text):
+  if not isinstance(text, text_type):
+    text = text.decode('latin-1')
+  return text.encode('utf-8', 'surrogatepass')
+
+
+def _decode_shared(data):
+  return text_type(data, 'utf-8', 'surrogatepass')
+
+
+def _pack_properties(props):
+  import zlib
+
+  if hasattr(props, 'keys'):
+    props = [(key, props[key]) for key in props]
+  else:
+    # later properties replace earlier ones with the same key
+    props = list(dict(props).items())
+
+  count = len(props)
+  table_size = 1
+  while table_size < count * 2:
+    table_size *= 2
+
+  table_start = _SHARED_HEADER.size + count * _SHARED_ENTRY.size
+  pool_start = table_start + table_size * 4
+
+  pool = bytearray()
+  entries = []
+  for key, value in props:
+    key = _encode_shared(_require_string(key, 'keys'))
+    value = _encode_shared(_require_string(value, 'values'))
+    key_start = len(pool)
+    pool += key
+    key_end = len(pool)
+    pool += value
+    entries.append((zlib.crc32(key) & 0xffffffff, key_start, key_end, len(pool)))
+
+  if pool_start + len(pool) > 0xffffffff:
+    raise ValueError('properties are too large to share')
+
+  data = bytearray(pool_start + len(pool))
+  _SHARED_HEADER.pack_into(data, 0, _SHARED_MAGIC, _SHARED_VERSION, count,
+                           table_size)
+
+  import struct
+  mask = table_size - 1
+  for idx, entry in enumerate(entries):
+    _SHARED_ENTRY.pack_into(
+      data, _SHARED_HEADER.size + idx * _SHARED_ENTRY.size, *entry)
+    slot = entry[0] & mask
+    while struct.unpack_from('<I', data, table_start + slot * 4)[0]:
+      slot = (slot + 1) & mask
+    struct.pack_into('<I', data, table_start + slot * 4, idx + 1)
+
+  data[pool_start:] = pool
+  return data
+
+
+################################################################################
+# Lossless tokens
+################################################################################
+
+
+def iter_tokens(fh, encoding=None):
+  """
+    Incrementally read a Java .properties file as ``jprops.Token`` objects
+    which cover the original text exactly, including blank lines, comments,
+    separators, continuation lines and line endings.
+
+    Writing the tokens back unchanged with ``write_tokens`` reproduces the
+    original file, so tools can rewrite just the properties they change. Keys
+    and values are only parsed when a token's ``key`` or ``value`` is used.
+
+    To reproduce a binary file exactly, write it with the same ``encoding``
+    it was read with.
+
+    :param fh: a readable file-like object
+    :param encoding: encoding of a binary file (default: latin-1)
+  """
+  blocks = _read_blocks(fh)
+  if not _is_text_file(fh):
+    encoding = _resolve_encoding(fh, encoding)
+    blocks = _decode_blocks(blocks, encoding, keep_bom=True)
+  return _scan_tokens(_physical_lines(blocks))
+
+
+def write_tokens(fh, tokens, encoding=None):
+  """
+    Writes tokens from ``iter_tokens`` to a file.
+
+    Binary files are written with the ``encoding`` (default: latin-1). When
+    writing latin-1, characters which it can't encode are written as ``\\u``
+    escapes.
+
+    :param fh: a writable file-like object
+    :param tokens: an iterable of ``jprops.Token`` objects
+    :param encoding: encoding of a binary file (default: latin-1)
+  """
+  if _is_text_file(fh):
+    for token in tokens:
+      fh.write(token.text)
+    return
+
+  encoding = encoding or 'latin-1'
+  latin_1 = codecs.lookup(encoding).name == 'iso8859-1'
+  # one encoder for the whole file, so encodings like utf-16 write a single
+  # byte order mark, in place of the one read as a 'bom' token
+  encoder = codecs.getincrementalencoder(encoding)()
+  skip_bom = _writes_bom(encoding)
+  for token in tokens:
+    text = token.text
+    if token.kind == Token.BOM and skip_bom:
+      continue
+    try:
+      data = encoder.encode(text)
+    except UnicodeEncodeError:
+      if not latin_1:
+        raise
+      data = encoder.encode(_COMMENT_UNICODE_ESCAPE.sub(_unicode_replace, text))
+    fh.write(data)
+  fh.write(encoder.encode(u'', True))
+
+
+def _writes_bom(encoding):
+  # an encoder which writes its own byte order mark encodes the first
+  # character differently from the next
+  encoder = codecs.getincrementalencoder(encoding)()
+  return encoder.encode(u' ') != encoder.encode(u' ')
+
+
+class Token(object):
+  """
+    A piece of a properties file from ``iter_tokens``.
+
+    ``kind`` is one of:
+
+    ``'entry'``
+      a property, including any continuation lines
+    ``'comment'``
+      a comment line
+    ``'blank'``
+      a line with only whitespace, or continuation lines without a property
+    ``'bom'``
+      a byte order mark at the start of a file read with an encoding
+
+    ``text`` is the exact original text, including the line ending. For
+    entries and comments, ``key`` and ``value`` are parsed like
+    ``iter_properties``, with ``jprops.COMMENT`` as the key of comments.
+  """
+  __slots__ = ('kind', 'text', '_parsed')
+
+  ENTRY = 'entry'
+  COMMENT = 'comment'
+  BLANK = 'blank'
+  BOM = 'bom'
+
+  def __init__(self, kind, text):
+    self.kind = kind
+    self.text = text
+    self._parsed = None
+
+  @classmethod
+  def entry(cls, key, value, newline=u'\n'):
+    """
+      Creates a new entry token for a property.
+    """
+    key = _escape_key(_require_string(key, 'keys'))
+    value = _escape_value(_require_string(value, 'values'))
+    return cls(cls.ENTRY, key + u'=' + value + newline)
+
+  @classmethod
+  def comment(cls, comment, newline=u'\n'):
+    """
+      Creates a new comment token, continuing multi-line comments like
+      ``write_comment``.
+    """
+    comment = _escape_comment(_require_string(comment, 'comments'))
+    return cls(cls.COMMENT, comment.replace(u'\n', newline) + newline)
+
+  def __repr__(self):
+    return 'Token(%r, %r)' % (self.kind, self.text)
+
+  def __eq__(self, other):
+    if not isinstance(other, Token):
+      return NotImplemented
+    return self.kind == other.kind and self.text == other.text
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  __hash__ = None
+
+  @property
+  def key(self):
+    return self._parse()[0]
+
+  @property
+  def value(self):
+    return self._parse()[1]
+
+  @property
+  def newline(self):
+    """
+      The line ending of the token, which is empty at the end of a file.
+    """
+    text = self.text
+    if text.endswith(u'\r\n'):
+      return u'\r\n'
+    if text.endswith((u'\n', u'\r')):
+      return text[-1]
+    return u''
+
+  def with_value(self, value):
+    """
+      Returns a copy of an entry token with a new value, keeping the original
+      key, separator and line ending.
+    """
+    if self.kind != self.ENTRY:
+      raise ValueError('only entry tokens have values to replace')
+
+    value = _escape_value(_require_string(value, 'values'))
+    first_line = self.text.split(u'\n', 1)[0].split(u'\r', 1)[0]
+    start = _value_start(first_line)
+    if start is None:
+      # the key has no separator on the first line, so write a new one
+      prefix = _escape_key(self.key) + u'='
+    else:
+      prefix = first_line[:start]
+    return Token(self.ENTRY, prefix + value + self.newline)
+
+  def _parse(self):
+    if self._parsed is not None:
+      return self._parsed
+    if self.kind not in (self.ENTRY, self.COMMENT):
+      raise ValueError('%s tokens have no key or value' % (self.kind,))
+
+    line = u''.join(_logical_pieces(self.text))
+    key, value = _split_key_value(line)
+    if key is not COMMENT:
+      key = _unescape(key)
+    self._parsed = key, _unescape(value)
+    return self._parsed
+
+
+def _physical_lines(blocks):
+  # split text blocks into lines, keeping each line's ending
+  pending = u''
+  for text in blocks:
+    if pending:
+      text = pending + text
+    if u'\r' not in text:
+      lines = text.split(u'\n')
+      pending = lines.pop()
+      for line in lines:
+        yield line + u'\n'
+      continue
+
+    pos = 0
+    end = len(text)
+    while pos < end:
+      n = text.find(u'\n', pos)
+      r = text.find(u'\r', pos, n if n >= 0 else end)
+      if r >= 0:
+        if r + 1 == end:
+          # the "\n" of a "\r\n" could be in the next block
+          break
+        stop = r + 2 if text[r+1] == u'\n' else r + 1
+      elif n >= 0:
+        stop = n + 1
+      else:
+        break
+      yield text[pos:stop]
+      pos = stop
+    pending = text[pos:]
+
+  if pending:
+    yield pending
+
+
+def _strip_newline(line):
+  if line.endswith(u'\n'):
+    line = line[:-1]
+  if line.endswith(u'\r'):
+    line = line[:-1]
+  return line
+
+
+def _continues(content):
+  # an odd number of trailing backslashes continues onto the next line
+  return (len(content) - len(content.rstrip(u'\\'))) % 2 == 1
+
+
+def _scan_tokens(lines):
+  group = None
+  for line in lines:
+    if group is not None:
+      # continuation of the previous line
+      group.append(line)
+      content = _strip_newline(line)
+      if not content.strip() or _continues(content):
+        # blank lines don't end a continuation, like _property_lines
+        continue
+      yield _continued_token(group)
+      group = None
+      continue
+
+    if line.startswith(u'\ufeff'):
+      yield Token(Token.BOM, u'\ufeff')
+      line = line[1:]
+      if not line:
+        continue
+
+    content = _strip_newline(line)
+    body = content.lstrip()
+    if not body:
+      yield Token(Token.BLANK, line)
+    elif _continues(content):
+      group = [line]
+    elif body[0] in _COMMENT_CHARS:
+      yield Token(Token.COMMENT, line)
+    else:
+      yield Token(Token.ENTRY, line)
+
+  if group is not None:
+    yield _continued_token(group)
+
+
+def _continued_token(group):
+  # comments continue onto the next line too, like _property_lines, and a
+  # group of only backslashes and blank lines has no property at all
+  text = u''.join(group)
+  logical = u''.join(_logical_pieces(text))
+  if not logical:
+    return Token(Token.BLANK, text)
+  if logical[0] in _COMMENT_CHARS:
+    return Token(Token.COMMENT, text)
+  return Token(Token.ENTRY, text)
+
+
+def _logical_pieces(text):
+  # the pieces of a token's text which make up its logical line
+  for line in _physical_lines([text]):
+    content = _strip_newline(line).lstrip()
+    if _continues(content):
+      content = content[:-1]
+    yield content
+
+
+def _value_start(line):
+  # returns the index where the value starts on the first line of an entry,
+  # or None if the key continues onto the next line
+  content = line.lstrip()
+  offset = len(line) - len(content)
+  if _continues(content):
+    content = content[:-1]
+
+  escaped = False
+  for idx, c in enumerate(content):
+    if not escaped and c in _KEY_TERMINATORS:
+      break
+    escaped = c == u'\\'
+  else:
+    return None
+
+  rest = content[idx+1:]
+  value = rest.lstrip()
+  if c not in _KEY_TERMINATORS_EXPLICIT and value[:1] in _KEY_TERMINATORS_EXPLICIT:
+    value = value[1:].lstrip()
+  return offset + len(content) - len(value)
+
+
+################################################################################
+# Sidecar index for random access
+################################################################################
+
+
+def build_index(path, encoding=None):
+  """
+    Writes a sidecar index for looking up properties in a large file with
+    ``lookup`` without parsing the whole file.
+
+    The index is written next to the file with an ``.idx`` extension. It holds
+    a hash of each key and the byte offset of the property in the file, along
+    with the encoding the file was read with, and the file's size and
+    modification time so ``lookup`` can tell when it's out of date. Returns the
+    path of the index.
+
+    Files in UTF-16 or UTF-32 can't be indexed.
+
+    :param path: path of the properties file
+    :param encoding: encoding of the file (default: latin-1)
+  """
+
+  import os
+  import tempfile
+
+  # stat before reading, so changes made while indexing make the index stale
+  size, mtime = _index_stamp(os.stat(path))
+
+  index_path = path + '.idx'
+  fd, tmp_path = tempfile.mkstemp(
+    dir=os.path.dirname(index_path) or '.',
+    prefix=os.path.basename(index_path) + '.')
+  try:
+    with os.fdopen(fd, 'wb') as out:
+      out.write(_INDEX_HEADER.pack(_INDEX_MAGIC, _INDEX_VERSION, 0, 0, 0, b''))
+      with io.open(path, 'rb') as fh:
+        encoding = _index_encoding(fh, encoding)
+        entries = _external_sorted(
+          _index_entries(fh, encoding), _INDEX_SORT_BUFFER_SIZE)
+        count = _write_index_entries(out, entries)
+      out.seek(0)
+      out.write(_INDEX_HEADER.pack(
+        _INDEX_MAGIC, _INDEX_VERSION, size, mtime, count,
+        encoding.encode('ascii')))
+    getattr(os, 'replace', os.rename)(tmp_path, index_path)
+  except BaseException:
+    os.remove(tmp_path)
+    raise
+  return index_path
+
+
+def lookup(path, key, default=None, encoding=None):
+  """
+    Looks up a single property in a file using its sidecar index from
+    ``build_index``, reading only the lines of that property from the file.
+
+    The index is built first if it doesn't exist, and rebuilt if the file's
+    size or modification time has changed since it was built. If a key
+    appears more than once, the last value is returned, like
+    ``load_properties``.
+
+    :param path: path of the properties file
+    :param key: the key to look up
+    :param default: value to return if the key isn't in the file
+    :param encoding: encoding of the file (default: latin-1), which is only
+      used when the index is built
+  """
+
+  import os
+  import zlib
+
+  key = _require_string(key, 'keys')
+  key_hash = zlib.crc32(_encode_index(key)) & 0xffffffff
+
+  found = _index_offsets(path, os.stat(path), key_hash)
+  if found is None:
+    build_index(path, encoding)
+    found = _index_offsets(path, os.stat(path), key_hash) or (None, [])
+  encoding, offsets = found
+
+  with io.open(path, 'rb') as fh:
+    # later properties replace earlier ones, so check the last one first
+    for offset in reversed(offsets):
+      line = next(_logical_lines(_index_lines(fh, offset, encoding)))
+      found_key, value = _split_key_value(line)
+      if found_key is not COMMENT and _unescape(found_key) == key:
+        return _unescape(value)
+  return default
+
+
+# The index is a header followed by (key hash, offset) entries sorted by hash
+# and then offset, all little-endian. The header ends with the name of the
+# codec the file was decoded with, padded with NULs.
+_INDEX_MAGIC = b'JPIX'
+_INDEX_VERSION = 3
+_INDEX_HEADER = _LazyStruct('_INDEX_HEADER', '<4sIQqQ32s')
+_INDEX_ENTRY = _LazyStruct('_INDEX_ENTRY', '<IQ')
+# entries are sorted in runs of this many, which keeps memory bounded for very
+# large files
+_INDEX_SORT_BUFFER_SIZE = 64 * 1024
+# lookups read a property in blocks of this size, since most are much shorter
+# than _BLOCK_SIZE
+_INDEX_BLOCK_SIZE = 4 * 1024
+
+
+def _index_stamp(st):
+  mtime = getattr(st, 'st_mtime_ns', None)
+  if mtime is None:
+    mtime = int(st.st_mtime * 1e9)
+  return st.st_size, mtime
+
+
+def _encode_index(key):
+  # Python 2 has no surrogatepass handler, but encodes lone surrogates anyway
+  return key.encode('utf-8', 'surrogatepass' if not PY2 else 'strict')
+
+
+def _index_encoding(fh, encoding):
+  # works out the codec the whole file is decoded with, after any fallback
+  # from invalid UTF-8 or byte order mark, so lookups don't have to
+  encoding = _resolve_encoding(fh, encoding)
+  start = fh.tell()
+  first = fh.read(4)
+  fh.seek(start)
+  return codecs.lookup(_detect_encoding(first, encoding)[0]).name
+
+
+def _index_lines(fh, offset, encoding):
+  # decodes the physical lines of the file from the offset, reading no more
+  # than the lines asked for
+  fh.seek(offset)
+  blocks = iter(lambda: fh.read(_INDEX_BLOCK_SIZE) or None, None)
+  lines = _split_lines(blocks, _BYTES_NEWLINE, b'\r')
+  for idx, (_, line) in enumerate(lines):
+    line = line.decode(encoding)
+    if idx == 0 and offset == 0 and line.startswith(u'\ufeff'):
+      line = line[1:]
+    yield line
+
+
+def _index_entries(fh, encoding):
+  import zlib
+
+  for line, location in _located_property_lines(fh, encoding):
+    key, _ = _split_key_value(line)
+    if key is not COMMENT:
+      key_hash = zlib.crc32(_encode_index(_unescape(key))) & 0xffffffff
+      yield key_hash, location.offset
+
+
+def _write_index_entries(out, entries):
+  pack = _INDEX_ENTRY.pack
+  count = 0
+  while True:
+    batch = [pack(*entry) for entry in itertools.islice(entries, 4096)]
+    if not batch:
+      return count
+    out.write(b''.join(batch))
+    count += len(batch)
+
+
+def _index_offsets(path, st, key_hash):
+  # returns the encoding of the file and the offsets of properties whose key
+  # has the hash, or None if the index is missing or out of date
+  import mmap
+
+  try:
+    fh = open(path + '.idx', 'rb')
+  except (IOError, OSError):
+    return None
+
+  with fh:
+    header = fh.read(_INDEX_HEADER.size)
+    if len(header) != _INDEX_HEADER.size:
+      return None
+    magic, version, size, mtime, count, encoding = _INDEX_HEADER.unpack(header)
+    if (magic != _INDEX_MAGIC or version != _INDEX_VERSION
+        or (size, mtime) != _index_stamp(st)):
+      return None
+
+    fh.seek(0, 2)
+    if fh.tell() != _INDEX_HEADER.size + count * _INDEX_ENTRY.size:
+      return None
+    encoding = encoding.rstrip(b'\0').decode('ascii')
+    if not count:
+      return encoding, []
+
+    mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      entry = _INDEX_ENTRY
+      start = _INDEX_HEADER.size
+
+      # binary search for the first entry with the hash
+      lo, hi = 0, count
+      while lo < hi:
+        mid = (lo + hi) // 2
+        if entry.unpack_from(mapped, start + mid * entry.size)[0] < key_hash:
+          lo = mid + 1
+        else:
+          hi = mid
+
+      offsets = []
+      for idx in range(lo, count):
+        entry_hash, offset = entry.unpack_from(mapped, start + idx * entry.size)
+        if entry_hash != key_hash:
+          break
+        offsets.append(offset)
+      return encoding, offsets
+    finally:
+      mapped.close()
+
+
+################################################################################
+# Command-line interface
+################################################################################
+
+
+def main(argv=None):
+  """
+    Runs the ``jprops`` command-line tool, returning the exit status.
+  """
+  import argparse
+
+  parser = argparse.ArgumentParser(
+    prog='jprops',
+    description='Work with Java .properties files. Use - to read stdin.',
+  )
+  subparsers = parser.add_subparsers(dest='command')
+  subparsers.required = True
+
+  p = subparsers.add_parser('get', help='print the values of keys')
+  p.add_argument('file', metavar='FILE')
+  p.add_argument('keys', nargs='+', metavar='KEY')
+  _add_input_arguments(p)
+  p.set_defaults(func=_cli_get)
+
+  p = subparsers.add_parser('dump', help='print the properties of files')
+  p.add_argument('files', nargs='*', default=['-'], metavar='FILE')
+  p.add_argument('-t', '--to', dest='to_format', choices=_FORMATS,
+                 default='properties', help='output format')
+  _add_input_arguments(p)
+  _add_jobs_argument(p)
+  p.set_defaults(func=_cli_dump)
+
+  p = subparsers.add_parser('convert', help='convert files to another format')
+  p.add_argument('files', nargs='+', metavar='FILE')
+  p.add_argument('-t', '--to', dest='to_format', choices=_FORMATS,
+                 required=True, help='output format')
+  p.add_argument('-o', '--output-dir',
+                 help='directory to write to (default: next to each file)')
+  _add_input_arguments(p)
+  _add_jobs_argument(p)
+  p.set_defaults(func=_cli_convert)
+
+  p = subparsers.add_parser('validate', help='check files for mistakes')
+  p.add_argument('files', nargs='+', metavar='FILE')
+  p.add_argument('-e', '--encoding',
+                 help='encoding of the files (default: latin-1)')
+  _add_jobs_argument(p)
+  p.set_defaults(func=_cli_validate)
+
+  p = subparsers.add_parser('diff', help='compare the properties of two files')
+  p.add_argument('old', metavar='OLD')
+  p.add_argument('new', metavar='NEW')
+  _add_input_arguments(p)
+  p.set_defaults(func=_cli_diff)
+
+  args = parser.parse_args(argv)
+  return args.func(args)
+
+
+_FORMATS = ('properties', 'json', 'env', 'yaml')
+_FORMAT_EXTENSIONS = {
+  '.properties': 'properties',
+  '.json': 'json',
+  '.env': 'env',
+  '.yaml': 'yaml',
+  '.yml': 'yaml',
+}
+
+
+def _add_input_arguments(parser):
+  parser.add_argument('-f', '--from', dest='from_format', choices=_FORMATS,
+                      help='input format (default: from the file extension)')
+  parser.add_argument('-e', '--encoding',
+                      help='encoding of properties files (default: latin-1)')
+
+
+def _add_jobs_argument(parser):
+  parser.add_argument('-j', '--jobs', type=int,
+                      help='number of files to process in parallel '
+                           '(default: number of CPUs)')
+
+
+def _parallel_map(func, items, jobs=None):
+  # lazily map over items in worker processes, keeping the results in order.
+  # Workers can't read stdin, so "-" is always handled in this process.
+  items = list(items)
+  if jobs is None:
+    import multiprocessing
+    jobs = multiprocessing.cpu_count()
+
+  remote = [item for item in items if item != '-']
+  if jobs <= 1 or len(remote) <= 1:
+    for item in items:
+      yield func(item)
+    return
+
+  import multiprocessing
+  pool = multiprocessing.Pool(min(jobs, len(remote)))
+  try:
+    results = pool.imap(func, remote)
+    for item in items:
+      yield func(item) if item == '-' else next(results)
+  finally:
+    pool.terminate()
+
+
+def _cli_error(path, error):
+  sys.stderr.write('jprops: %s: %s\n' % (path, error))
+
+
+def _cli_get(args):
+  keys = set(args.keys)
+  found = {}
+  try:
+    for key, value in _read_path(args.file, args.from_format, args.encoding):
+      if key in keys:
+        found[key] = value
+  except (IOError, OSError, ValueError) as e:
+    _cli_error(args.file, e)
+    return 1
+
+  status = 0
+  out = _stdout_text()
+  for key in args.keys:
+    if key in found:
+      out.write(found[key] + u'\n')
+    else:
+      _cli_error(args.file, 'key not found: %s' % key)
+      status = 1
+  out.flush()
+  return status
+
+
+def _cli_dump(args):
+  import functools
+  import os
+  import shutil
+
+  out = _stdout_bytes()
+  if len(args.files) == 1:
+    # stream a single file straight to the output
+    path = args.files[0]
+    try:
+      pairs = _read_path(path, args.from_format, args.encoding)
+      _WRITERS[args.to_format](out, pairs)
+    except (IOError, OSError, ValueError) as e:
+      out.flush()
+      _cli_error(path, e)
+      return 1
+    out.flush()
+    return 0
+
+  status = 0
+  dump = functools.partial(
+    _dump_path,
+    from_format=args.from_format,
+    to_format=args.to_format,
+    encoding=args.encoding,
+  )
+  for path, output, error in _parallel_map(dump, args.files, args.jobs):
+    try:
+      if error is not None:
+        _cli_error(path, error)
+        status = 1
+      else:
+        with open(output, 'rb') as fp:
+          shutil.copyfileobj(fp, out)
+        out.flush()
+    finally:
+      os.remove(output)
+  return status
+
+
+def _dump_path(path, from_format, to_format, encoding):
+  # writes the output to a temporary file rather than memory, which the main
+  # process streams to stdout in order
+  import tempfile
+
+  fd, output = tempfile.mkstemp(prefix='jprops-dump-')
+  try:
+    with io.open(fd, 'wb') as out:
+      _WRITERS[to_format](out, _read_path(path, from_format, encoding))
+  except (IOError, OSError, ValueError) as e:
+    return path, output, str(e)
+  return path, output, None
+
+
+def _cli_convert(args):
+  import functools
+
+  status = 0
+  convert = functools.partial(
+    _convert_path,
+    from_format=args.from_format,
+    to_format=args.to_format,
+    encoding=args.encoding,
+    output_dir=args.output_dir,
+  )
+  for path, output, error in _parallel_map(convert, args.files, args.jobs):
+    if error is not None:
+      _cli_error(path, error)
+      status = 1
+  return status
+
+
+def _convert_path(path, from_format, to_format, encoding, output_dir):
+  import os
+
+  output = '-'
+  try:
+    if path != '-':
+      output = _converted_path(path, to_format, output_dir)
+      if os.path.abspath(output) == os.path.abspath(path):
+        raise ValueError('converting would overwrite the input file')
+
+    pairs = _read_path(path, from_format, encoding)
+    if output == '-':
+      out = _stdout_bytes()
+      _WRITERS[to_format](out, pairs)
+      out.flush()
+    else:
+      with open_properties(output, 'w') as out:
+        _WRITERS[to_format](out, pairs)
+  except (IOError, OSError, ValueError) as e:
+    return path, output, str(e)
+  return path, output, None
+
+
+def _converted_path(path, to_format, output_dir=None):
+  import os
+
+  base = path
+  if _compression_for_path(base) is not None:
+    base = os.path.splitext(base)[0]
+  base = os.path.splitext(base)[0] + '.' + to_format
+  if output_dir is not None:
+    base = os.path.join(output_dir, os.path.basename(base))
+  return base
+
+
+def _cli_validate(args):
+  import functools
+
+  status = 0
+  check = functools.partial(_validate_path, encoding=args.encoding)
+  out = _stdout_text()
+  for path, diagnostics in _parallel_map(check, args.files, args.jobs):
+    for line, code, message in diagnostics:
+      status = 1
+      out.write(u'%s:%s: %s: %s\n' % (path, line, code, message))
+    out.flush()
+  return status
+
+
+def _validate_path(path, encoding=None):
+  try:
+    with _open_input(path) as fp:
+      return path, validate(fp, encoding)
+  except (IOError, OSError, ValueError) as e:
+    return path, [Diagnostic(0, 'error', str(e))]
+
+
+def _cli_diff(args):
+  loaded = []
+  for path in (args.old, args.new):
+    try:
+      loaded.append(dict(_read_path(path, args.from_format, args.encoding)))
+    except (IOError, OSError, ValueError) as e:
+      _cli_error(path, e)
+      return 2
+  old, new = loaded
+
+  status = 0
+  out = _stdout_text()
+  for key in sorted(set(old).union(new)):
+    old_value = old.get(key)
+    new_value = new.get(key)
+    if old_value == new_value:
+      continue
+    status = 1
+    escaped_key = _escape_key(key)
+    if old_value is not None:
+      out.write(u'-%s=%s\n' % (escaped_key, _escape_value(old_value)))
+    if new_value is not None:
+      out.write(u'+%s=%s\n' % (escaped_key, _escape_value(new_value)))
+  out.flush()
+  return status
+
+
+def _stdout_bytes():
+  return getattr(sys.stdout, 'buffer', sys.stdout)
+
+
+def _stdout_text():
+  return codecs.getwriter('utf-8')(_stdout_bytes())
+
+
+class _StdinInput(object):
+  # context manager for reading stdin which leaves it open afterwards
+  def __enter__(self):
+    return getattr(sys.stdin, 'buffer', sys.stdin)
+
+  def __exit__(self, *exc_info):
+    pass
+
+
+def _open_input(path):
+  if path == '-':
+    return _StdinInput()
+  return open_properties(path)
+
+
+def _read_path(path, input_format=None, encoding=None):
+  # yields the pairs from a file in any of the supported formats
+  if input_format is None:
+    input_format = _format_for_path(path)
+
+  with _open_input(path) as fp:
+    if input_format == 'properties':
+      pairs = iter_properties(fp, encoding=encoding)
+    else:
+      pairs = _READERS[input_format](codecs.getreader('utf-8')(fp))
+    for pair in pairs:
+      yield pair
+
+
+def _format_for_path(path):
+  import os
+
+  base = path
+  if _compression_for_path(base) is not None:
+    base = os.path.splitext(base)[0]
+  ext = os.path.splitext(base)[1].lower()
+  return _FORMAT_EXTENSIONS.get(ext, 'properties')
+
+
+def _flatten(obj, prefix=u''):
+  # flatten nested objects from JSON or YAML to dotted keys
+  if isinstance(obj, dict):
+    for key, value in obj.items():
+      key = u'%s' % (key,)
+      for pair in _flatten(value, prefix + u'.' + key if prefix else key):
+        yield pair
+  elif isinstance(obj, list) and any(isinstance(v, (dict, list)) for v in obj):
+    for idx, value in enumerate(obj):
+      for pair in _flatten(value, u'%s.%d' % (prefix, idx)):
+        yield pair
+  elif isinstance(obj, list):
+    yield prefix, u','.join(_scalar_text(v) for v in obj)
+  else:
+    yield prefix, _scalar_text(obj)
+
+
+def _scalar_text(value):
+  if value is None:
+    return u''
+  if value is True:
+    return u'true'
+  if value is False:
+    return u'false'
+  return u'%s' % (value,)
+
+
+def _read_json(fp):
+  import json
+  return _flatten(json.load(fp))
+
+
+def _read_yaml(fp):
+  try:
+    import yaml
+  except ImportError:
+    raise ValueError('reading YAML requires the PyYAML package')
+  return _flatten(yaml.safe_load(fp) or {})
+
+
+def _read_env(fp):
+  import shlex
+
+  # quoted values may span lines, so the whole file is split into words
+  lexer = shlex.shlex(fp.read(), posix=True)
+  lexer.whitespace_split = True
+  lexer.commenters = '#'
+  for word in lexer:
+    if word == u'export':
+      continue
+    key, sep, value = word.partition(u'=')
+    if not sep:
+      raise ValueError('invalid word in env file: %r' % (word,))
+    yield key, value
+
+
+def _write_properties(out, pairs):
+  store_properties(out, pairs, timestamp=False)
+
+
+def _last_values(pairs):
+  # later properties replace earlier ones, but formats like JSON and YAML don't
+  # allow repeated keys, so keep each key once at its first position
+  from collections import OrderedDict
+  props = OrderedDict()
+  for key, value in pairs:
+    props[key] = value
+  return props.items()
+
+
+def _write_json(out, pairs):
+  import json
+
+  out = codecs.getwriter('utf-8')(out)
+  sep = u'{\n  '
+  for key, value in _last_values(pairs):
+    out.write(sep)
+    out.write(json.dumps(key, ensure_ascii=False))
+    out.write(u': ')
+    out.write(json.dumps(value, ensure_ascii=False))
+    sep = u',\n  '
+  out.write(u'{}\n' if sep.startswith(u'{') else u'\n}\n')
+
+
+def _write_env(out, pairs):
+  try:
+    from shlex import quote
+  except ImportError:
+    from pipes import quote
+
+  out = codecs.getwriter('utf-8')(out)
+  for key, value in pairs:
+    if not _ENV_NAME.match(key):
+      raise ValueError('key is not a valid environment variable name: %r'
+                       % (key,))
+    out.write(u'%s=%s\n' % (key, quote(value)))
+
+
+_ENV_NAME = _LazyPattern('_ENV_NAME', r'[A-Za-z_][A-Za-z0-9_]*\Z')
+
+
+def _write_yaml(out, pairs):
+  import json
+
+  # JSON strings are valid YAML scalars, so they're used to quote everything
+  out = codecs.getwriter('utf-8')(out)
+  empty = True
+  for key, value in _last_values(pairs):
+    out.write(u'%s: %s\n' % (json.dumps(key, ensure_ascii=False),
+                             json.dumps(value, ensure_ascii=False)))
+    empty = False
+  if empty:
+    out.write(u'{}\n')
+
+
+_READERS = {
+  'json': _read_json,
+  'yaml': _read_yaml,
+  'env': _read_env,
+}
+_WRITERS = {
+  'properties': _write_properties,
+  'json': _write_json,
+  'env': _write_env,
+  'yaml': _write_yaml,
+}
+
+
+if __name__ == '__main__':
+  # run with the importable module, so that functions can be sent to workers
+  import jprops
+  sys.exit(jprops.main())
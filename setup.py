@@ -26,6 +26,9 @@ setuptools.setup(
   platforms = 'any',
 
   py_modules = ['jprops'],
+  entry_points = {
+    'console_scripts': ['jprops = jprops:main'],
+  },
 
   zip_safe = True,
   verbose = False,
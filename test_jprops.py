@@ -344,3 +344,836 @@ def test_comment_identity():
   assert copy.copy(jprops.COMMENT) is jprops.COMMENT
   assert copy.deepcopy(jprops.COMMENT) is jprops.COMMENT
   assert pickle.loads(pickle.dumps(jprops.COMMENT)) is jprops.COMMENT
+
+
+def test_store_properties_sort_keys_mapping():
+  fp = BytesIO()
+  props = {u'b': u'2', u'c': u'3', u'a': u'1'}
+  jprops.store_properties(fp, props, timestamp=False, sort_keys=True)
+  assert fp.getvalue() == b'a=1\nb=2\nc=3\n'
+
+
+def test_store_properties_sort_keys_pairs():
+  fp = BytesIO()
+  pairs = iter([(u'b', u'2'), (u'a', u'1'), (u'b', u'0')])
+  jprops.store_properties(fp, pairs, timestamp=False, sort_keys=True)
+  assert fp.getvalue() == b'a=1\nb=2\nb=0\n'
+
+
+@pytest.mark.parametrize('buffer_size', [1, 2, 3, 100])
+def test_store_properties_external_sort(buffer_size):
+  pairs = [
+    (u'%d' % (i * 7 % 10), u'v%d \u0100\\\n' % i) for i in range(20)
+  ]
+  # keys ending in a backslash aren't read back correctly from the properties
+  # format, so they check that runs are spilled losslessly
+  pairs += [(u'\\', u''), (u'zz\\', u' \\'), (u'\ud800', u'\udfff')]
+  expected = BytesIO()
+  jprops.store_properties(expected, pairs, timestamp=False, sort_keys=True)
+
+  fp = BytesIO()
+  jprops.store_properties(fp, (pair for pair in pairs), timestamp=False,
+                          sort_keys=True, sort_buffer_size=buffer_size)
+  assert fp.getvalue() == expected.getvalue()
+  sorted_pairs = jprops._sorted_pairs(iter(pairs), buffer_size)
+  assert list(sorted_pairs) == sorted(pairs, key=lambda pair: pair[0])
+
+
+def test_store_properties_invalid_sort_buffer_size():
+  with raises(ValueError):
+    jprops.store_properties(BytesIO(), [], sort_keys=True, sort_buffer_size=0)
+
+
+@pytest.mark.parametrize('file_type', [BytesIO, StringIO])
+@pytest.mark.parametrize('pairs', [
+  [],
+  [(u'a', u'1'), (u'b c', u' x y'), (u'=:#!', u'\t\\\n\r\f'), (u'', u'')],
+  [(u'\u0100\u4e00', u'\x7f\x01\xe9 \u0100'), (u'k\x0b', u'\x0b v')],
+  # the separator for escaping whole columns
+  [(u'a\x00', u'1'), (u'b', u'\x00 2')],
+  [(u'%d' % i, u'%c' % (0x4e00 + i)) for i in range(5000)],
+])
+def test_store_many(file_type, pairs):
+  expected = file_type()
+  jprops.store_properties(expected, pairs, timestamp=False)
+
+  keys = [k for k, v in pairs]
+  values = [v for k, v in pairs]
+  fp = file_type()
+  jprops.store_many(fp, iter(keys), values)
+  assert fp.getvalue() == expected.getvalue()
+
+  fp = file_type()
+  jprops.store_many(fp, keys, values, trusted=True)
+  assert fp.getvalue() == expected.getvalue()
+
+
+def test_store_many_escaped():
+  fp = BytesIO()
+  jprops.store_many(fp, [u'a\\ b'], [u'\\u0100 \u0100'], escaped=True)
+  assert fp.getvalue() == b'a\\ b=\\u0100 \\u0100\n'
+
+
+def test_store_many_errors():
+  with raises(TypeError):
+    jprops.store_many(BytesIO(), [u'a', 1], [u'1', u'2'])
+  with raises(ValueError):
+    jprops.store_many(BytesIO(), [u'a', u'b'], [u'1'])
+
+
+@pytest.mark.parametrize('sort_buffer_size', [1, 2, 64 * 1024])
+def test_lookup(tmpdir, monkeypatch, sort_buffer_size):
+  monkeypatch.setattr(jprops, '_INDEX_SORT_BUFFER_SIZE', sort_buffer_size)
+  path = str(tmpdir.join('x.properties'))
+  with open(path, 'wb') as fp:
+    fp.write(b'\xef\xbb\xbfa=1\r\n# a=comment\r\nb = two\\\r\n  lines\r'
+             b'k\\ x:\xc4\x80\n\na=3\nlast')
+
+  assert jprops.lookup(path, u'a', encoding='utf-8') == u'3'
+  assert jprops.lookup(path, u'b', encoding='utf-8') == u'twolines'
+  assert jprops.lookup(path, u'k x', encoding='utf-8') == u'\u0100'
+  assert jprops.lookup(path, u'last', encoding='utf-8') == u''
+  assert jprops.lookup(path, u'# a', encoding='utf-8') is None
+  assert jprops.lookup(path, u'c', default=u'x', encoding='utf-8') == u'x'
+  assert tmpdir.join('x.properties.idx').check()
+
+
+def test_lookup_invalid_utf8(tmpdir):
+  # the whole file is read as latin-1, like load_properties, even though the
+  # property looked up is valid UTF-8
+  path = str(tmpdir.join('x.properties'))
+  with open(path, 'wb') as fp:
+    fp.write(b'a=\xff\nb=\xc3\xa9\n')
+
+  with open(path, 'rb') as fp:
+    expected = jprops.load_properties(fp, encoding='utf-8')
+  assert jprops.lookup(path, u'b', encoding='utf-8') == expected[u'b']
+  assert jprops.lookup(path, u'b', encoding='utf-8') == u'\u00c3\u00a9'
+  assert jprops.lookup(path, u'a', encoding='utf-8') == u'\u00ff'
+
+
+def test_lookup_rebuilds_stale_index(tmpdir):
+  path = str(tmpdir.join('x.properties'))
+  with open(path, 'wb') as fp:
+    fp.write(b'a=1\n')
+  assert jprops.build_index(path) == path + '.idx'
+  assert jprops.lookup(path, u'a') == u'1'
+
+  with open(path, 'ab') as fp:
+    fp.write(b'b=2\na=3\n')
+  assert jprops.lookup(path, u'b') == u'2'
+  assert jprops.lookup(path, u'a') == u'3'
+
+  with open(path + '.idx', 'wb') as fp:
+    fp.write(b'garbage')
+  assert jprops.lookup(path, u'a') == u'3'
+  assert sorted(tmpdir.listdir()) == [
+    tmpdir.join('x.properties'), tmpdir.join('x.properties.idx')]
+
+
+@pytest.mark.parametrize('filename,compression', [
+  ('x.properties', None),
+  ('x.properties.gz', 'gzip'),
+  ('x.properties.bz2', 'bz2'),
+  ('x.properties.xz', 'xz'),
+])
+def test_open_properties_compression(tmpdir, filename, compression):
+  path = str(tmpdir.join(filename))
+  props = {u'a': u'\u0100', u'b': u'x' * 100000}
+  with jprops.open_properties(path, 'w') as fp:
+    jprops.store_properties(fp, props, timestamp=False)
+
+  assert jprops._sniff_compression(path) == compression
+
+  # compression is detected by content, not the file name
+  renamed = str(tmpdir.join('renamed'))
+  tmpdir.join(filename).rename(renamed)
+  with jprops.open_properties(renamed) as fp:
+    assert jprops.load_properties(fp) == props
+
+
+def test_open_properties_explicit_compression(tmpdir):
+  path = str(tmpdir.join('x.properties'))
+  with jprops.open_properties(path, 'w', compression='gzip') as fp:
+    jprops.write_property(fp, u'a', u'1')
+  assert tmpdir.join('x.properties').read_binary()[:2] == b'\x1f\x8b'
+  with jprops.open_properties(path, compression='gzip') as fp:
+    assert jprops.load_properties(fp) == {u'a': u'1'}
+
+
+def test_open_properties_invalid_args(tmpdir):
+  path = str(tmpdir.join('x.properties'))
+  with raises(ValueError):
+    jprops.open_properties(path, 'a')
+  with raises(ValueError):
+    jprops.open_properties(path, 'w', compression='rar')
+
+
+@pytest.mark.parametrize('data,encoding,expected', [
+  (b'a=\xc4\x80\n', None, u'\u00c4\u0080'),
+  (b'a=\xc4\x80\n', 'utf-8', u'\u0100'),
+  (b'\xef\xbb\xbfa=\xc4\x80\n', 'utf-8', u'\u0100'),
+  (b'\xef\xbb\xbfa=\xc4\x80\n', 'latin-1', u'\u0100'),
+  (codecs.BOM_UTF16_LE + u'a=\u0100\n'.encode('utf-16-le'), 'utf-8', u'\u0100'),
+  (codecs.BOM_UTF16_BE + u'a=\u0100\n'.encode('utf-16-be'), 'utf-8', u'\u0100'),
+  # invalid UTF-8 falls back to latin-1
+  (b'a=\xff\n', 'utf-8', u'\u00ff'),
+  (b'a=\xc4\n', 'utf-8', u'\u00c4'),
+])
+def test_read_bytes_encoding(data, encoding, expected):
+  props = jprops.load_properties(BytesIO(data), encoding=encoding)
+  assert props == {u'a': expected}
+
+
+def test_read_bytes_encoding_ignored_for_text():
+  props = jprops.load_properties(StringIO(u'a=\u00ff\n'), encoding='utf-8')
+  assert props == {u'a': u'\u00ff'}
+
+
+def test_read_bytes_encoding_fallback_whole_file(monkeypatch):
+  # like Java, invalid UTF-8 anywhere decodes the whole file as latin-1
+  monkeypatch.setattr(jprops, '_BLOCK_SIZE', 4)
+  data = b'a=\xc3\xa9\nb=\xff\n'
+  props = jprops.load_properties(BytesIO(data), encoding='utf-8')
+  assert props == {u'a': u'\u00c3\u00a9', u'b': u'\u00ff'}
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r', '\r\n'])
+@pytest.mark.parametrize('block_size', [1, 2, 3, 5, 64])
+def test_read_bytes_block_boundaries(monkeypatch, newline, block_size):
+  monkeypatch.setattr(jprops, '_BLOCK_SIZE', block_size)
+  text = u'a=\u0100\\\n  b\n\nc:d\n#e\nf\n'.replace(u'\n', newline)
+  expected = [(u'a', u'\u0100b'), (u'c', u'd'), (u'f', u'')]
+  fp = BytesIO(text.encode('utf-8'))
+  assert list(jprops.iter_properties(fp, encoding='utf-8')) == expected
+
+
+def test_typed_properties_schema():
+  import datetime
+  props = jprops.TypedProperties({
+    u'size': u'10',
+    u'ratio': u'0.5',
+    u'enabled': u'True',
+    u'timeout': u'1m30s',
+    u'hosts': u'a, b,c',
+    u'name': u'x',
+  }, schema={
+    u'size': int,
+    u'ratio': 'float',
+    u'enabled': bool,
+    u'timeout': 'duration',
+    u'hosts': 'list',
+  })
+  assert props[u'size'] == 10
+  assert props[u'ratio'] == 0.5
+  assert props[u'enabled'] is True
+  assert props[u'timeout'] == datetime.timedelta(seconds=90)
+  assert props[u'hosts'] == [u'a', u'b', u'c']
+  assert props[u'name'] == u'x'
+  assert len(props) == 6
+  assert props.bulk_convert() == {
+    u'size': 10,
+    u'ratio': 0.5,
+    u'enabled': True,
+    u'timeout': datetime.timedelta(seconds=90),
+    u'hosts': [u'a', u'b', u'c'],
+  }
+
+
+@pytest.mark.parametrize('value,expected', [
+  (u'5', 5),
+  (u'1.5', 1.5),
+  (u'250ms', 0.25),
+  (u'2h', 7200),
+  (u'1d 1h', 90000),
+  (u'1.5m', 90),
+])
+def test_typed_properties_duration(value, expected):
+  props = jprops.TypedProperties({u'x': value})
+  assert props.get_duration(u'x').total_seconds() == expected
+
+
+def test_typed_properties_getters():
+  props = jprops.TypedProperties({u'x': u'42', u'y': u'off', u'z': u''})
+  assert props.get_int(u'x') == 42
+  assert props.get_str(u'x') == u'42'
+  assert props.get_float(u'x') == 42.0
+  assert props.get_bool(u'y') is False
+  assert props.get_list(u'z') == []
+  assert props.get_int(u'missing') is None
+  assert props.get_int(u'missing', 7) == 7
+
+
+def test_typed_properties_caches_conversions():
+  calls = []
+  def convert(value):
+    calls.append(value)
+    return value.upper()
+
+  props = jprops.TypedProperties({u'x': u'a'}, schema={u'x': convert})
+  assert props[u'x'] == u'A'
+  assert props[u'x'] == u'A'
+  assert props.bulk_convert() == {u'x': u'A'}
+  assert calls == [u'a']
+
+
+def test_typed_properties_error_reports_line():
+  fp = BytesIO(b'# pool\npool.size = \\\n  ten\nok=1\n')
+  props = jprops.TypedProperties.load(fp, schema={u'pool.size': int})
+  assert props.line(u'pool.size') == 2
+  assert props.get_int(u'ok') == 1
+  with raises(jprops.PropertyValueError) as exc_info:
+    props[u'pool.size']
+  err = exc_info.value
+  assert isinstance(err, ValueError)
+  assert (err.key, err.value, err.type_name, err.line) == \
+    (u'pool.size', u'ten', 'int', 2)
+  assert 'line 2' in str(err)
+
+
+@pytest.mark.parametrize('type_name,value', [
+  ('bool', u'maybe'),
+  ('duration', u'5 fortnights'),
+  ('duration', u''),
+  ('duration', u'inf'),
+  ('duration', u'1e20'),
+  ('duration', u'99999999999d'),
+  ('float', u'x'),
+])
+def test_typed_properties_invalid_values(type_name, value):
+  props = jprops.TypedProperties({u'x': value}, schema={u'x': type_name})
+  with raises(jprops.PropertyValueError):
+    props[u'x']
+
+
+def test_typed_properties_invalid_schema():
+  with raises(ValueError):
+    jprops.TypedProperties({}, schema={u'x': 'complex'})
+  with raises(TypeError):
+    jprops.TypedProperties({}, schema={u'x': 1})
+
+
+@pytest.mark.parametrize('newline', ['\n', '\r', '\r\n'])
+@pytest.mark.parametrize('block_size', [1, 2, 64])
+def test_iter_properties_locations(monkeypatch, newline, block_size):
+  monkeypatch.setattr(jprops, '_BLOCK_SIZE', block_size)
+  lines = [u'#c', u'a=1', u'', u'  b=\\', u'   2\\', u'3', u'c=\u0100']
+  data = newline.join(lines).encode('utf-8')
+  n = len(newline)
+  expected = [
+    (jprops.COMMENT, u'c', (1, 1, 0)),
+    (u'a', u'1', (2, 2, 2 + n)),
+    (u'b', u'23', (4, 6, 5 + 3 * n)),
+    (u'c', u'\u0100', (7, 7, 16 + 6 * n)),
+  ]
+  actual = list(jprops.iter_properties(BytesIO(data), comments=True,
+                                       encoding='utf-8', locations=True))
+  assert actual == expected
+  assert isinstance(actual[0][2], jprops.Location)
+
+  # text files count offsets in characters
+  text = data.decode('utf-8')
+  actual = list(jprops.iter_properties(StringIO(text), locations=True))
+  assert actual == expected[1:]
+
+
+def test_load_properties_locations():
+  locations = jprops.PropertyLocations()
+  fp = BytesIO(b'a=1\nb=2\na=3\\\n  4\n')
+  props = jprops.load_properties(fp, locations=locations)
+  assert props == {u'a': u'34', u'b': u'2'}
+  assert dict(locations) == {
+    u'a': jprops.Location(start_line=3, end_line=4, offset=8),
+    u'b': jprops.Location(start_line=2, end_line=2, offset=4),
+  }
+  assert locations[u'a'].start_line == 3
+
+
+@pytest.mark.parametrize('block_size', [1, 4, 64 * 1024])
+def test_locations_same_values_with_encoding_fallback(monkeypatch, block_size):
+  monkeypatch.setattr(jprops, '_BLOCK_SIZE', block_size)
+  data = b'a=\xc3\xa9\r\nb=\xff\n'
+  expected = jprops.load_properties(BytesIO(data), encoding='utf-8')
+  located = jprops.iter_properties(BytesIO(data), encoding='utf-8',
+                                   locations=True)
+  assert [(k, v) for k, v, _ in located] == list(expected.items())
+  typed = jprops.TypedProperties.load(BytesIO(data), encoding='utf-8')
+  assert dict(typed) == expected
+
+
+def test_locations_require_ascii_compatible_encoding():
+  data = codecs.BOM_UTF16_LE + u'a=1\n'.encode('utf-16-le')
+  with raises(ValueError):
+    list(jprops.iter_properties(BytesIO(data), encoding='utf-8',
+                                locations=True))
+
+
+def _wait_for(condition, timeout=5):
+  import time
+  deadline = time.time() + timeout
+  while not condition():
+    if time.time() > deadline:
+      raise AssertionError('timed out waiting for condition')
+    time.sleep(0.01)
+
+
+@pytest.mark.parametrize('use_inotify', [False, True])
+def test_watched_properties_reloads(tmpdir, use_inotify):
+  path = tmpdir.join('watched.properties')
+  path.write_binary(b'a=1\nb=2\n')
+
+  changes = []
+  with jprops.WatchedProperties(str(path), debounce=0.01, interval=0.01,
+                                use_inotify=use_inotify) as props:
+    if use_inotify and props.metrics()['watcher'] != 'inotify':
+      pytest.skip('inotify is not available')
+
+    props.on_change(lambda *change: changes.append(change))
+    props.on_change(lambda *change: changes.append(('b only',) + change),
+                    keys=[u'b'])
+    assert dict(props) == {u'a': u'1', u'b': u'2'}
+    before = props.snapshot()
+
+    # replace the file by renaming over it, like many editors do
+    tmp = tmpdir.join('tmp')
+    tmp.write_binary(b'a=1\nb=3\nc=4\n')
+    tmp.rename(path)
+    _wait_for(lambda: props.reload_count == 1)
+
+    assert dict(props) == {u'a': u'1', u'b': u'3', u'c': u'4'}
+    assert before == {u'a': u'1', u'b': u'2'}
+    assert sorted(changes, key=str) == sorted([
+      (u'b', u'2', u'3'),
+      (u'c', None, u'4'),
+      ('b only', u'b', u'2', u'3'),
+    ], key=str)
+
+    metrics = props.metrics()
+    assert metrics['reload_count'] == 1
+    assert metrics['last_reload_latency'] >= 0
+
+
+def test_watched_properties_keeps_old_values_on_error(tmpdir):
+  path = tmpdir.join('watched.properties')
+  path.write_binary(b'a=1\n')
+  with jprops.WatchedProperties(str(path), use_inotify=False) as props:
+    path.remove()
+    assert not props.reload()
+    assert isinstance(props.last_error, (IOError, OSError))
+    assert dict(props) == {u'a': u'1'}
+
+
+def test_watched_properties_survives_truncated_gzip(tmpdir):
+  import gzip
+  path = tmpdir.join('watched.properties.gz')
+  with jprops.open_properties(str(path), 'w') as fp:
+    jprops.store_properties(fp, {u'a': u'1'})
+  with jprops.WatchedProperties(str(path), debounce=0.01, interval=0.01,
+                                use_inotify=False) as props:
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as fp:
+      fp.write(b'a=2\n' * 1000)
+    data = buf.getvalue()
+    path.write_binary(data[:len(data) // 2])
+    _wait_for(lambda: isinstance(props.last_error, EOFError))
+    assert props._thread.is_alive()
+    assert dict(props) == {u'a': u'1'}
+
+    path.write_binary(data)
+    _wait_for(lambda: props.get(u'a') == u'2')
+    assert props.last_error is None
+
+
+def test_resource_bundles(tmpdir):
+  tmpdir.join('messages.properties').write_binary(
+    b'hello=Hello\nbye=Bye\ncolor=color\n')
+  tmpdir.join('messages_fr.properties').write_binary(
+    u'hello=Bonjour\nbye=Au revoir\ncolor=couleur\n'.encode('utf-8'))
+  tmpdir.join('messages_fr_CA.properties').write_binary(
+    u'hello=All\u00f4\ncolor=couleur\n'.encode('utf-8'))
+
+  bundles = jprops.ResourceBundles(str(tmpdir), 'messages')
+  fr_ca = bundles.get_bundle('fr-ca')
+  assert fr_ca.locale == 'fr_CA'
+  assert dict(fr_ca) == {
+    u'hello': u'All\u00f4',
+    u'bye': u'Au revoir',
+    u'color': u'couleur',
+  }
+  assert fr_ca.parent is bundles.get_bundle('fr')
+  assert fr_ca.parent.parent is bundles.get_bundle('')
+  assert dict(bundles.get_bundle('')) == {
+    u'hello': u'Hello',
+    u'bye': u'Bye',
+    u'color': u'color',
+  }
+
+  # only the values which differ from the parent are stored
+  assert fr_ca._own == {u'hello': u'All\u00f4'}
+
+  # locales without a file use their parent's bundle
+  assert bundles.get_bundle('fr_FR') is fr_ca.parent
+  assert bundles.get_bundle('de')[u'hello'] == u'Hello'
+  assert u'bye' in fr_ca
+  assert u'missing' not in fr_ca
+  with raises(KeyError):
+    fr_ca[u'missing']
+
+
+def test_resource_bundles_missing(tmpdir):
+  bundles = jprops.ResourceBundles(str(tmpdir), 'messages')
+  with raises(LookupError):
+    bundles.get_bundle('fr')
+
+
+@pytest.mark.parametrize('locale,expected', [
+  ('', ''),
+  ('FR', 'fr'),
+  ('fr-ca', 'fr_CA'),
+  ('es_419', 'es_419'),
+  ('zh-hant-tw', 'zh_Hant_TW'),
+  ('no_NO_NY', 'no_NO_NY'),
+])
+def test_normalize_locale(locale, expected):
+  assert jprops._normalize_locale(locale) == expected
+
+
+def test_validate():
+  fp = BytesIO(
+    b'a=1\n'
+    b'# comment with \\uzzzz and an escaped slash \\\\\n'
+    b'b=\\u00zz\n'
+    b'c=\\\\u00zz \\\\\\u12\n'
+    b'a\\\n'
+    b'  =2\n'
+    b'd=\\u0041\n'
+    b'e=\\\n'
+  )
+  assert jprops.validate(fp) == [
+    (3, 'invalid-unicode-escape', "malformed \\uxxxx escape: '\\\\u00zz'"),
+    (4, 'invalid-unicode-escape', "malformed \\uxxxx escape: '\\\\u12'"),
+    (5, 'duplicate-key', "duplicate key 'a', first defined on line 1"),
+    (8, 'continuation-at-eof', 'line continues past the end of the file'),
+  ]
+
+
+def test_validate_utf_16():
+  data = codecs.BOM_UTF16_LE + u'a=\u0100\na=2\n'.encode('utf-16-le')
+  assert jprops.load_properties(BytesIO(data), encoding='utf-8') == {
+    u'a': u'2'}
+  assert [(d.line, d.code) for d in jprops.validate(BytesIO(data), 'utf-8')] \
+    == [(1, 'non-latin-1'), (2, 'duplicate-key')]
+
+
+def test_validate_continued_comment():
+  fp = BytesIO(b'a=1\n#note \\\na=2\n')
+  assert list(jprops.iter_properties(BytesIO(fp.getvalue()))) == [(u'a', u'1')]
+  assert jprops.validate(fp) == [
+    (2, 'continued-comment', 'comment continues onto the next line'),
+  ]
+
+
+def test_validate_valid_file():
+  fp = BytesIO(b'a=1\nb=\\u00ff\\\\u\n#a=2\n')
+  assert jprops.validate(fp) == []
+
+
+def test_validate_non_latin_1():
+  fp = BytesIO(u'a=\u00ff\nb=\u0100\n'.encode('utf-8'))
+  diagnostics = jprops.validate(fp, encoding='utf-8')
+  assert [(d.line, d.code) for d in diagnostics] == [(2, 'non-latin-1')]
+
+
+def _run_main(args, stdin):
+  # runs the command in a new process, since pool workers can't read stdin
+  import os
+  import subprocess
+  import sys
+  proc = subprocess.Popen(
+    [sys.executable, '-m', 'jprops'] + args,
+    stdin=subprocess.PIPE,
+    stdout=subprocess.PIPE,
+    cwd=os.path.dirname(os.path.abspath(jprops.__file__)),
+  )
+  out, _ = proc.communicate(stdin)
+  return proc.returncode, out
+
+
+def test_main_validate(tmpdir, capsys):
+  good = tmpdir.join('good.properties')
+  good.write_binary(b'a=1\n')
+  bad = tmpdir.join('bad.properties')
+  bad.write_binary(b'a=1\na=2\n')
+
+  assert jprops.main(['validate', str(good)]) == 0
+  assert capsys.readouterr().out == ''
+
+  args = ['validate', '--jobs', '2', str(good), str(bad)]
+  assert jprops.main(args) == 1
+  assert capsys.readouterr().out == (
+    "%s:2: duplicate-key: duplicate key 'a', first defined on line 1\n" % bad)
+
+
+def test_main_validate_stdin_with_files(tmpdir):
+  good = str(tmpdir.join('good.properties'))
+  with open(good, 'wb') as fp:
+    fp.write(b'a=1\n')
+  status, out = _run_main(['validate', '-j', '2', good, '-'], b'zz=1\nzz=2\n')
+  assert status == 1
+  assert out == b"-:2: duplicate-key: duplicate key 'zz', first defined on line 1\n"
+
+
+def test_main_get(tmpdir, capsys):
+  path = tmpdir.join('a.properties')
+  path.write_binary(b'a=1\nb=\\u0100\n')
+  assert jprops.main(['get', str(path), 'b', 'a']) == 0
+  assert capsys.readouterr().out == u'\u0100\n1\n'
+  assert jprops.main(['get', str(path), 'c']) == 1
+  assert 'key not found: c' in capsys.readouterr().err
+
+
+@pytest.mark.parametrize('to_format,expected', [
+  ('properties', b'a=1\nb_c=\\u0100\n'),
+  ('json', u'{\n  "a": "1",\n  "b_c": "\u0100"\n}\n'.encode('utf-8')),
+  ('env', u"a=1\nb_c='\u0100'\n".encode('utf-8')),
+  ('yaml', u'"a": "1"\n"b_c": "\u0100"\n'.encode('utf-8')),
+])
+def test_main_dump(tmpdir, capsysbinary, to_format, expected):
+  path = tmpdir.join('a.properties')
+  path.write_binary(b'a=1\nb_c=\\u0100\n')
+  assert jprops.main(['dump', '--to', to_format, str(path)]) == 0
+  assert capsysbinary.readouterr().out == expected
+
+  # multiple files are dumped in order
+  assert jprops.main(['dump', '--to', to_format, '-j', '2',
+                      str(path), str(path)]) == 0
+  assert capsysbinary.readouterr().out == expected * 2
+
+
+@pytest.mark.parametrize('to_format,expected', [
+  ('json', b'{\n  "a": "3",\n  "b": "2"\n}\n'),
+  ('yaml', b'"a": "3"\n"b": "2"\n'),
+])
+def test_main_dump_duplicate_keys(tmpdir, capsysbinary, to_format, expected):
+  path = tmpdir.join('a.properties')
+  path.write_binary(b'a=1\nb=2\na=3\n')
+  assert jprops.main(['dump', '--to', to_format, str(path)]) == 0
+  assert capsysbinary.readouterr().out == expected
+
+
+def test_main_dump_env_invalid_name(tmpdir, capsys):
+  path = tmpdir.join('a.properties')
+  path.write_binary(b'b.c=1\n')
+  assert jprops.main(['dump', '--to', 'env', str(path)]) == 1
+  captured = capsys.readouterr()
+  assert captured.out == ''
+  assert 'not a valid environment variable name' in captured.err
+
+
+def test_main_dump_stdin_with_files(tmpdir):
+  path = str(tmpdir.join('a.properties'))
+  with open(path, 'wb') as fp:
+    fp.write(b'a=1\n')
+  args = ['dump', '-j', '2', path, '-', path]
+  assert _run_main(args, b'zz=stdin\n') == (0, b'a=1\nzz=stdin\na=1\n')
+
+
+@pytest.mark.parametrize('from_format,data', [
+  ('json', b'{"a": "1", "b": {"c": "\\u0100", "d": [1, true]}}'),
+  ('yaml', b'a: "1"\nb:\n  c: "\\u0100"\n  d: [1, true]\n'),
+  ('env', u'a=1\nexport b.c="\u0100"\nb.d=1,true\n'.encode('utf-8')),
+])
+def test_main_convert(tmpdir, from_format, data):
+  if from_format == 'yaml':
+    pytest.importorskip('yaml')
+  path = tmpdir.join('a.' + from_format)
+  path.write_binary(data)
+  assert jprops.main(['convert', '--to', 'properties', str(path)]) == 0
+  with open(str(tmpdir.join('a.properties')), 'rb') as fp:
+    assert jprops.load_properties(fp) == {
+      u'a': u'1',
+      u'b.c': u'\u0100',
+      u'b.d': u'1,true',
+    }
+
+
+def test_main_convert_round_trip(tmpdir):
+  props = {u'a': u'1', u'b': u' x\ny\u0100'}
+  src = tmpdir.mkdir('src')
+  out = tmpdir.mkdir('out')
+  paths = []
+  for name in ('x', 'y'):
+    path = src.join(name + '.properties.gz')
+    with jprops.open_properties(str(path), 'w') as fp:
+      jprops.store_properties(fp, props)
+    paths.append(str(path))
+
+  for fmt in ('json', 'env'):
+    args = ['convert', '--to', fmt, '-o', str(out), '-j', '2'] + paths
+    assert jprops.main(args) == 0
+    for name in ('x', 'y'):
+      converted = str(out.join('%s.%s' % (name, fmt)))
+      assert dict(jprops._read_path(converted)) == props
+
+
+def test_main_convert_refuses_to_overwrite(tmpdir, capsys):
+  path = tmpdir.join('a.properties')
+  path.write_binary(b'a=1\n')
+  assert jprops.main(['convert', '--to', 'properties', str(path)]) == 1
+  assert 'overwrite' in capsys.readouterr().err
+  assert path.read_binary() == b'a=1\n'
+
+
+def test_main_diff(tmpdir, capsys):
+  old = tmpdir.join('old.properties')
+  old.write_binary(b'a=1\nb=2\nc=3\n')
+  new = tmpdir.join('new.json')
+  new.write_binary(b'{"a": "1", "b": "two", "d": " 4"}')
+  assert jprops.main(['diff', str(old), str(old)]) == 0
+  assert capsys.readouterr().out == ''
+  assert jprops.main(['diff', str(old), str(new)]) == 1
+  assert capsys.readouterr().out == '-b=2\n+b=two\n-c=3\n+d=\\ 4\n'
+
+
+def test_import_is_lazy():
+  # importing jprops should only load modules which Python loads at startup,
+  # see benchmarks/importtime.py for timing the import
+  import subprocess
+  import sys
+  code = (
+    'import sys\n'
+    'before = set(sys.modules)\n'
+    'import jprops\n'
+    'print(" ".join(sorted(set(sys.modules) - before)))\n'
+  )
+  output = subprocess.check_output([sys.executable, '-c', code])
+  imported = set(output.decode('ascii').split()) - set(['jprops'])
+  assert imported <= set(['itertools'])
+
+
+def _read_shared(props, key):
+  return props[key]
+
+
+def test_shared_properties_buffer():
+  props = {u'a': u'1', u'b': u'\u0100\ud800', u'': u'empty'}
+  for i in range(100):
+    props[u'key%d' % i] = u'value%d' % i
+  shared = jprops.SharedProperties(jprops._pack_properties(props))
+  assert shared.name is None
+  assert len(shared) == len(props)
+  assert dict(shared) == props
+  assert shared[u'b'] == u'\u0100\ud800'
+  assert u'missing' not in shared
+  assert 1 not in shared
+  assert dict(pickle.loads(pickle.dumps(shared))) == props
+
+
+def test_shared_properties_duplicate_pairs():
+  packed = jprops._pack_properties([(u'a', u'1'), (u'a', u'2')])
+  assert dict(jprops.SharedProperties(packed)) == {u'a': u'2'}
+
+
+def test_shared_properties_invalid_buffer():
+  with raises(ValueError):
+    jprops.SharedProperties(b'not properties at all')
+
+
+def test_share_properties_between_processes():
+  pytest.importorskip('multiprocessing.shared_memory')
+  import multiprocessing
+
+  props = {u'a': u'1', u'b': u'\u0100'}
+  shared = jprops.share_properties(props)
+  try:
+    with jprops.attach_properties(shared.name) as attached:
+      assert dict(attached) == props
+
+    pool = multiprocessing.Pool(2)
+    try:
+      results = pool.starmap(_read_shared, [(shared, u'a'), (shared, u'b')])
+    finally:
+      pool.terminate()
+    assert results == [u'1', u'\u0100']
+  finally:
+    shared.close()
+    shared.unlink()
+
+
+class _SmallReads(BytesIO):
+  def read(self, size=-1):
+    return BytesIO.read(self, 3)
+
+  read1 = read
+
+
+@pytest.mark.parametrize('data,encoding', [
+  (b'# comment\n\n  a = 1\nb:\\\n   two\\\n\n  three\n!x\\\nmore\nlast', 'utf-8'),
+  (b'# comment\r\n\r\n  a = 1\r\nb:\\\r\n   two\\\r\n\r\n  three\r\nlast\r\n',
+   'utf-8'),
+  (b'# comment\r\r  a = 1\rb:\\\r   two\\\r\r  three\rlast\r', 'utf-8'),
+  (b'\xef\xbb\xbfa=\xc4\x80\r\n\t\n', 'utf-8'),
+  (codecs.BOM_UTF16_LE + u'a=\u0100\r\n#c\nb=\\\n 2'.encode('utf-16-le'),
+   'utf-16-le'),
+  (codecs.BOM_UTF16 + u'a=\u0100\r\n#c\nb=\\\n 2'.encode('utf-16')[2:],
+   'utf-16'),
+])
+def test_tokens_round_trip(data, encoding):
+  tokens = list(jprops.iter_tokens(BytesIO(data), encoding=encoding))
+  assert list(jprops.iter_tokens(_SmallReads(data), encoding=encoding)) == tokens
+
+  out = BytesIO()
+  jprops.write_tokens(out, tokens, encoding=encoding)
+  assert out.getvalue() == data
+
+  text = data.decode(encoding)
+  out = StringIO()
+  jprops.write_tokens(out, jprops.iter_tokens(StringIO(text, newline='')))
+  assert out.getvalue() == text
+
+  props = jprops.iter_properties(BytesIO(data), comments=True, encoding=encoding)
+  parsed = [(t.key, t.value) for t in tokens if t.kind in ('entry', 'comment')]
+  assert parsed == list(props)
+
+
+def test_tokens_lone_continuation_is_blank():
+  data = b'\n\\\r\n'
+  tokens = list(jprops.iter_tokens(BytesIO(data)))
+  assert [t.kind for t in tokens] == ['blank', 'blank']
+  assert list(jprops.iter_properties(BytesIO(data), comments=True)) == []
+
+
+def test_tokens_kinds():
+  data = b'# c\n\n  \na=1\n#x\\\ny=2\nb\\\n  c\n'
+  tokens = list(jprops.iter_tokens(BytesIO(data)))
+  assert [t.kind for t in tokens] == [
+    'comment', 'blank', 'blank', 'entry', 'comment', 'entry']
+  assert tokens[4].text == u'#x\\\ny=2\n'
+  assert (tokens[5].key, tokens[5].value) == (u'bc', u'')
+  with raises(ValueError):
+    tokens[1].key
+
+
+@pytest.mark.parametrize('text,expected', [
+  (u'  a = 1\r\n', u'  a = new\r\n'),
+  (u'a:1\\\n  2\n', u'a:new\n'),
+  (u'a:\\\n  1\n', u'a:new\n'),
+  (u'a\\\nb=1\n', u'ab=new\n'),
+  (u'a', u'a=new'),
+])
+def test_token_with_value(text, expected):
+  token, = jprops.iter_tokens(StringIO(text, newline=''))
+  assert token.with_value(u'new').text == expected
+
+
+def test_write_tokens():
+  tokens = [
+    jprops.Token.comment(u'one\ntwo'),
+    jprops.Token.entry(u'a b', u'\u0100', newline=u'\r\n'),
+  ]
+  out = BytesIO()
+  jprops.write_tokens(out, tokens)
+  assert out.getvalue() == b'#one\n#two\na\\ b=\\u0100\r\n'
+
+  with raises(ValueError):
+    tokens[0].with_value(u'x')